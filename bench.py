@@ -0,0 +1,173 @@
+"""Micro-benchmarks for the bot's hot paths.
+
+Run `python bench.py` for everything or `python bench.py <name> ...` for a subset.
+Nothing here talks to Discord; the bot module is imported with its data
+directory pointed at a throwaway folder.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="queen-bench-"))
+import main
+
+BENCHES = {}
+
+def bench(fn):
+    BENCHES[fn.__name__.removeprefix("bench_")] = fn
+    return fn
+
+def traced_bytes(build):
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+def snowflakes(n, seed=1):
+    rng = random.Random(seed)
+    return [rng.randrange(10**17, 2 * 10**18) for _ in range(n)]
+
+@bench
+def bench_memory_layout(n=200_000):
+    """Resident size of one guild's levels and balances: original dict layout vs CompactTable."""
+    ids = snowflakes(n)
+    _, dict_levels = traced_bytes(lambda: {str(uid): {"xp": i % 500, "level": 1 + i % 90} for i, uid in enumerate(ids)})
+    _, dict_money = traced_bytes(lambda: {str(uid): i * 7 for i, uid in enumerate(ids)})
+
+    def build_levels():
+        table = main.LevelTable()
+        for i, uid in enumerate(ids): table.put(uid, main.DEFAULT_CURVE.total_for(1 + i % 90) + i % 500)
+        return table
+
+    def build_money():
+        table = main.BalanceTable()
+        for i, uid in enumerate(ids): table.set_balance(uid, i * 7)
+        return table
+
+    levels, table_levels = traced_bytes(build_levels)
+    money, table_money = traced_bytes(build_money)
+    print(f"{n:,} users")
+    print(f"  levels  dict {dict_levels / n:7.1f} B/user   table {table_levels / n:7.1f} B/user   ({dict_levels / table_levels:.1f}x smaller, nbytes() ~{levels.nbytes() / n:.1f} B/user)")
+    print(f"  money   dict {dict_money / n:7.1f} B/user   table {table_money / n:7.1f} B/user   ({dict_money / table_money:.1f}x smaller, nbytes() ~{money.nbytes() / n:.1f} B/user)")
+
+    started = time.perf_counter()
+    for uid in ids[:100_000]: levels.add_xp(uid, 15)
+    print(f"  add_xp  {(time.perf_counter() - started) / 100_000 * 1e9:7.0f} ns/call")
+
+@bench
+def bench_cooldowns(n=1_000_000, checks=500_000):
+    """Per-message XP cooldown check with 1M tracked members: f-string dict (old) vs CooldownWheel."""
+    rng = random.Random(2)
+    guilds = [rng.randrange(10**17, 2 * 10**18) for _ in range(1000)]
+    members = [(guilds[i % 1000], rng.randrange(10**17, 2 * 10**18)) for i in range(n)]
+    sample = [members[rng.randrange(n)] for _ in range(checks)]
+    now = time.monotonic()
+
+    old = {}
+    for guild_id, user_id in members: old[f"{guild_id}-{user_id}"] = now + 60
+    started = time.perf_counter()
+    for guild_id, user_id in sample:
+        key = f"{guild_id}-{user_id}"
+        if key not in old or now > old[key]: old[key] = now + 60
+    old_ns = (time.perf_counter() - started) / checks * 1e9
+    _, old_bytes = traced_bytes(lambda: {f"{g}-{u}": now + 60 for g, u in members})
+    del old
+
+    wheel = main.CooldownWheel(now=now)
+    def fill():
+        for i, (guild_id, user_id) in enumerate(members): wheel.try_acquire(guild_id, user_id, 60, now + i * 60 / n)
+    _, wheel_bytes = traced_bytes(fill)
+    wheel.try_acquire(0, 0, 60, now + 60)   # pay the one-off sweep of the first minute outside the timing
+    started = time.perf_counter()
+    for guild_id, user_id in sample: wheel.try_acquire(guild_id, user_id, 60, now + 60)
+    wheel_ns = (time.perf_counter() - started) / checks * 1e9
+    print(f"{n:,} tracked members, {checks:,} checks")
+    print(f"  f-string dict   {old_ns:6.0f} ns/check   {old_bytes / n:6.1f} B/member   never reclaimed")
+    print(f"  CooldownWheel   {wheel_ns:6.0f} ns/check   {wheel_bytes / n:6.1f} B/member   nbytes() ~{wheel.nbytes() / n:.1f} B/member")
+    wheel.try_acquire(0, 0, 60, now + 600)
+    print(f"  after 10 idle minutes: {len(wheel):,} tracked, {wheel.reclaimed:,} reclaimed")
+
+@bench
+def bench_prefix_filter(messages=200_000):
+    """Per-message prefix check for ordinary chat: original get_prefix + startswith vs the cached PrefixTrie."""
+    rng = random.Random(3)
+    guild_id = 123456789012345678
+    main.get_guild_data(main.config_db, guild_id).update({"prefix": "q!", "prefixes": ["q!", "?", "queen "]})
+    # Bot.user is read-only before login, so seed the cached trie (with the mention forms) the way prefix_table would.
+    main.prefix_tables[guild_id] = main.PrefixTrie(main.guild_prefixes(guild_id) + ["<@987654321098765432> ", "<@!987654321098765432> "])
+    words = ["hello", "what", "is", "up", "lol", "anyone", "here", "gg", "nice", "ok"]
+    chat = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 12))) for _ in range(messages)]
+
+    started = time.perf_counter()
+    for content in chat:
+        prefix = main.get_guild_data(main.config_db, guild_id).get("prefix", main.DEFAULT_PREFIX)
+        content.startswith(prefix)
+    old_ns = (time.perf_counter() - started) / messages * 1e9
+
+    started = time.perf_counter()
+    for content in chat: main.prefix_table(guild_id).match(content)
+    trie_ns = (time.perf_counter() - started) / messages * 1e9
+    print(f"{messages:,} non-command messages, 3 prefixes + 2 mention forms")
+    print(f"  original prefix lookup  {old_ns:6.0f} ns/msg, then a full Context build in process_commands")
+    print(f"  PrefixTrie pre-filter   {trie_ns:6.0f} ns/msg, and process_commands is skipped")
+
+@bench
+def bench_automod(rate=5000, seconds=20, members=50_000, channels=500):
+    """Automod.check at a sustained 5k messages/sec over a mix of chatters, spammers and copy-pasters."""
+    rng = random.Random(4)
+    guild_id = 123456789012345678
+    users = snowflakes(members, seed=5)
+    lines = ["hello", "anyone here?", "gg", "lol that was close", "what time is the event", "nice", "ok"]
+    messages = []
+    for i in range(rate * seconds):
+        user = users[rng.randrange(members)] if i % 50 else users[0]   # users[0] floods
+        content = "FREE NITRO discord.gift/xyz" if i % 97 == 0 else rng.choice(lines) + " " + str(rng.randrange(100))
+        messages.append((users[1] if i % 97 == 0 else user, rng.randrange(channels), content, 6 if i % 997 == 0 else 0))
+    automod, start = main.Automod(), time.monotonic()
+
+    def run():
+        for i, (user, channel, content, mentions) in enumerate(messages): automod.check(guild_id, channel, user, content, mentions, start + i / rate)
+
+    started = time.perf_counter()
+    run()
+    per_msg = (time.perf_counter() - started) / len(messages)
+    _, size = traced_bytes(lambda: [main.MemberActivity() for _ in range(10_000)])
+    print(f"{len(messages):,} messages at {rate:,}/s from {members:,} members in {channels} channels")
+    print(f"  check            {per_msg * 1e9:6.0f} ns/msg   {per_msg * rate * 100:.2f}% of one core at {rate:,} msg/s")
+    print(f"  member record    {size / 10_000:6.0f} B, fixed   {len(automod.members) + len(automod.previous):,} tracked at the end")
+    print("  flagged          " + ", ".join(f"{count:,} {reason}" for reason, count in automod.flagged.items()))
+
+@bench
+def bench_keyword_rules(messages=20_000):
+    """Banned-word scan per message as the rule count grows: one `in` check per word vs the guild's Aho-Corasick automaton."""
+    rng = random.Random(6)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(20_000)]
+    chat = [" ".join(rng.choice(vocab[10_000:]) for _ in range(rng.randint(3, 20))) for _ in range(messages)]
+    print(f"{messages:,} messages of 3-20 words")
+    for count in (10, 100, 1_000, 10_000):
+        words = vocab[:count]
+        started = time.perf_counter()
+        for content in chat:
+            text = content.lower()
+            any(word in text for word in words)
+        naive_ns = (time.perf_counter() - started) / messages * 1e9
+        started = time.perf_counter()
+        rules = main.GuildRules(words, {})
+        rules.scan("warm up")   # link the automaton outside the timing
+        build_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for content in chat: rules.scan(content)
+        ac_ns = (time.perf_counter() - started) / messages * 1e9
+        print(f"  {count:6,} rules   naive {naive_ns / 1000:8.1f} us/msg   automaton {ac_ns / 1000:6.1f} us/msg   (built in {build_ms:.0f} ms)")
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHES[name]()
+        print()
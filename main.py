@@ -1,47 +1,270 @@
 import discord
 from discord.ext import commands
 import json
+import sqlite3
 import os
 import random
 from datetime import datetime, timedelta
-from flask import Flask
-from threading import Thread
+from aiohttp import web
+from threading import Thread, Lock, get_ident, current_thread, main_thread
 import asyncio
 import time
 import sys
 import operator
+import re
+import heapq
+import signal
+import io
+import traceback
+import tracemalloc
+from math import isqrt
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 
 # ==========================================
 # ⚠️ CONFIGURATION
 # ==========================================
 TOKEN = os.getenv("DISCORD_TOKEN")
-if not TOKEN:
-    print("FATAL ERROR: DISCORD_TOKEN environment variable not found. Please set it and restart.")
-    sys.exit()
 
 DEFAULT_PREFIX = "!"
 
 # ==========================================
-# 🌐 24/7 UPTIME SERVER
+# 🌐 HEALTH & METRICS SERVER
 # ==========================================
-app = Flask('')
-@app.route('/')
-def home():
-    return "I'm alive! The QueenAI Bot is running 24/7."
-def run():
-    app.run(host='0.0.0.0', port=8080)
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("PORT", "8080"))
+READY_MAX_LATENCY = float(os.getenv("READY_MAX_LATENCY", "5"))   # gateway heartbeat latency (s) above which we report not ready
+READY_MAX_LAG = float(os.getenv("READY_MAX_LAG", "1"))           # event-loop lag (s) above which we report not ready
+PROCESS_STARTED = time.monotonic()
+
+LAG_THRESHOLD = float(os.getenv("LAG_THRESHOLD", "0.25"))   # seconds of loop lag that count as a stall
+
+class LoopLagMonitor:
+    """Continuous event-loop lag probe with a watchdog thread that catches the culprit.
+
+    The probe task notes when it goes to sleep and measures how late it wakes:
+    the overshoot is time the loop spent busy or blocked. A daemon thread
+    checks that heartbeat; once it is overdue by LAG_THRESHOLD it grabs the
+    loop thread's current stack, logs the innermost frame of ours together with
+    the command, event or task it belongs to, and the probe later charges the
+    whole stall to that source in `blocked`.
+    """
+    def __init__(self, interval=0.25, threshold=LAG_THRESHOLD):
+        self.interval, self.threshold = interval, threshold
+        self.last = self.max = self.total = 0.0
+        self.samples = 0
+        self.beat = time.monotonic()
+        self.loop_thread = None
+        self.stall = None      # (source, location) captured by the watchdog for the current stall
+        self.blocked = {}      # source -> [stalls, seconds blocked]
+        self._commands = None  # callback code object -> command name, built on first stall
+        self._task = None
+
+    async def _run(self):
+        self.loop_thread = get_ident()
+        Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        while True:
+            started = time.perf_counter()
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.last, self.max = lag, max(self.max, lag)
+            self.total += lag
+            self.samples += 1
+            if lag >= self.threshold:
+                entry = self.blocked.setdefault(self.stall[0] if self.stall else "unattributed", [0, 0.0])
+                entry[0] += 1
+                entry[1] += lag
+            self.stall = None
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            if self.stall is not None or time.monotonic() - self.beat <= self.interval + self.threshold: continue
+            if (frame := sys._current_frames().get(self.loop_thread)) is None: continue
+            source, location = self.stall = self.attribute(frame)
+            stack = "".join(traceback.format_stack(frame, limit=6))
+            print(f"⚠️ Event loop blocked for {time.monotonic() - self.beat - self.interval:.2f}s+ by {source} at {location}\n{stack}")
+
+    def attribute(self, frame):
+        """(source, location): the command, event handler or task running in `frame`, and our innermost frame."""
+        if self._commands is None: self._commands = {command.callback.__code__: command.qualified_name for command in bot.walk_commands()}
+        location = event = outermost = None
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == __file__:
+                if location is None: location = f"line {frame.f_lineno} in {code.co_name}"
+                if code in self._commands: return f"command:{self._commands[code]}", location
+                if event is None and code.co_name.startswith("on_"): event = f"event:{code.co_name}"
+                outermost = code.co_qualname
+            frame = frame.f_back
+        if location is None: return "library", "outside main.py"
+        return event or f"task:{outermost}", location
+
+    def worst(self, n=3):
+        return sorted(self.blocked.items(), key=lambda item: item[1][1], reverse=True)[:n]
+
+    def summary(self):
+        avg = self.total / self.samples if self.samples else 0.0
+        worst = "".join(f"\n`{source}` {stalls} stalls · {seconds:.2f}s" for source, (stalls, seconds) in self.worst())
+        return f"lag last {self.last * 1000:.1f}ms · avg {avg * 1000:.1f}ms · max {self.max * 1000:.0f}ms{worst}"
+
+    def start(self):
+        if not self._task: self._task = asyncio.create_task(self._run())
+
+class GatewayState:
+    """Whether the gateway session is up, maintained by on_ready/on_resumed/on_disconnect."""
+    def __init__(self):
+        self.connected = False
+        self.ready_once = False
+        self.disconnects = 0
+
+loop_lag = LoopLagMonitor()
+gateway = GatewayState()
+
+def readiness():
+    latency = bot.latency
+    checks = {
+        "gateway_connected": gateway.connected and not bot.is_closed(),
+        "ready": gateway.ready_once and bot.is_ready(),
+        "latency_ok": latency == latency and latency < READY_MAX_LATENCY,   # NaN until the first heartbeat
+        "loop_lag_ok": loop_lag.last < READY_MAX_LAG,
+    }
+    return all(checks.values()), checks
+
+def collect_metrics():
+    """(name, type, help, [(labels, value)]) for every exported series."""
+    one = lambda value: [({}, value)]
+    ready, _ = readiness()
+    latency = bot.latency if bot.latency == bot.latency else -1
+    return [
+        ("up_seconds", "gauge", "Seconds since the process started.", one(time.monotonic() - PROCESS_STARTED)),
+        ("ready", "gauge", "1 when /readyz passes.", one(int(ready))),
+        ("gateway_latency_seconds", "gauge", "Gateway heartbeat latency (-1 before the first heartbeat).", one(latency)),
+        ("gateway_disconnects_total", "counter", "Gateway disconnects since start.", one(gateway.disconnects)),
+        ("guilds", "gauge", "Guilds the bot is in.", one(len(bot.guilds))),
+        ("event_loop_lag_seconds", "gauge", "Most recent event-loop lag sample.", one(loop_lag.last)),
+        ("event_loop_lag_max_seconds", "gauge", "Largest event-loop lag seen.", one(loop_lag.max)),
+        ("event_loop_lag_seconds_total", "counter", "Sum of event-loop lag samples.", one(loop_lag.total)),
+        ("event_loop_lag_samples_total", "counter", "Event-loop lag samples taken.", one(loop_lag.samples)),
+        ("event_loop_stalls_total", "counter", "Lag samples over LAG_THRESHOLD, by the command/event/task blocking the loop.", [({"source": source}, stalls) for source, (stalls, _) in loop_lag.blocked.items()]),
+        ("event_loop_blocked_seconds_total", "counter", "Seconds of stalls, by the command/event/task blocking the loop.", [({"source": source}, seconds) for source, (_, seconds) in loop_lag.blocked.items()]),
+        ("xp_queue_depth", "gauge", "XP grants waiting to be applied.", one(xp_pipeline.queue.qsize())),
+        ("xp_grants_total", "counter", "XP grants by outcome.", [({"outcome": "applied"}, xp_pipeline.applied), ({"outcome": "shed"}, xp_pipeline.dropped)]),
+        ("xp_batches_total", "counter", "XP batches applied.", one(xp_pipeline.batches)),
+        ("outbound_pending", "gauge", "Messages waiting in outbound lanes.", one(sum(len(lane.heap) for lane in outbound.lanes.values()))),
+        ("outbound_lanes", "gauge", "Channels with an active outbound lane.", one(len(outbound.lanes))),
+        ("outbound_messages_total", "counter", "Outbound messages by outcome.", [({"outcome": k}, getattr(outbound, k)) for k in ("sent", "merged", "dropped", "failed")]),
+        ("reminders_pending", "gauge", "Reminders waiting to fire.", one(len(reminders.heap))),
+        ("reminders_delivered_total", "counter", "Reminders delivered.", one(reminders.delivered)),
+        ("temp_punishments_queued", "gauge", "Tempmute/tempban expiries queued.", one(len(expiries.heap))),
+        ("guild_cache_entries", "gauge", "Resident (store, guild) pairs.", one(len(guild_cache.entries))),
+        ("guild_cache_bytes", "gauge", "Estimated bytes of resident guild data.", one(guild_cache.total)),
+        ("guild_cache_budget_bytes", "gauge", "Memory budget for resident guild data.", one(guild_cache.budget)),
+        ("guild_cache_loads_total", "counter", "Guild stores loaded from storage.", one(guild_cache.loads)),
+        ("guild_cache_evictions_total", "counter", "Guild stores evicted.", one(guild_cache.evictions)),
+        ("persistence_flushes_total", "counter", "Background flushes.", one(persistence.flushes)),
+        ("persistence_rows_written_total", "counter", "Rows written by flushes.", one(persistence.rows_written)),
+        ("persistence_merged_total", "counter", "Mutations folded into an already dirty row.", one(persistence.merged)),
+        ("persistence_errors_total", "counter", "Failed writes and compactions.", one(persistence.errors)),
+        ("persistence_pending_mutations", "gauge", "Mutations since the last flush.", one(persistence.pending)),
+        ("persistence_flush_seconds_total", "counter", "Total time spent flushing.", one(persistence.total_ms / 1000)),
+        ("persistence_flush_max_seconds", "gauge", "Slowest flush.", one(persistence.max_ms / 1000)),
+        ("storage_compactions_total", "counter", "Journal compactions.", one(storage.compactions)),
+        ("xp_cooldowns_tracked", "gauge", "Members on XP cooldown.", one(len(xp_cooldowns))),
+        ("member_name_cache_entries", "gauge", "Cached leaderboard names.", one(len(member_names.cache))),
+        ("guild_config_cache_entries", "gauge", "Cached guild config snapshots.", one(len(guild_configs))),
+        ("permission_cache_entries", "gauge", "Cached permission decisions.", one(len(permission_decisions))),
+        ("message_index_bytes", "gauge", "Estimated bytes held by channel message buffers.", one(message_index.total)),
+        ("message_index_channels", "gauge", "Channels with a message buffer.", one(len(message_index.channels))),
+        ("automod_members_tracked", "gauge", "Members with automod state.", one(len(automod.members) + len(automod.previous))),
+        ("automod_flagged_total", "counter", "Messages flagged by automod.", [({"reason": reason}, count) for reason, count in automod.flagged.items()]),
+        ("raids_detected_total", "counter", "Join raids detected.", one(join_guard.detected)),
+        *command_metrics.families(),
+    ]
+
+def prometheus_text(families):
+    lines = []
+    for name, kind, doc, samples in families:
+        lines.append(f"# HELP queen_{name} {doc}")
+        lines.append(f"# TYPE queen_{name} {kind}")
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ("", *sample)   # histograms add _bucket/_sum/_count
+            label_text = "{" + ",".join(f'{key}="{val}"' for key, val in labels.items()) + "}" if labels else ""
+            lines.append(f"queen_{name}{suffix}{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+async def handle_home(request):
+    return web.Response(text="I'm alive! The QueenAI Bot is running 24/7.")
+
+async def handle_healthz(request):
+    # Answering at all proves the loop is running; a closed client means the process is winding down.
+    alive = not bot.is_closed()
+    return web.json_response({"status": "ok" if alive else "closing", "uptime_s": round(time.monotonic() - PROCESS_STARTED)}, status=200 if alive else 503)
+
+async def handle_readyz(request):
+    ready, checks = readiness()
+    return web.json_response({"status": "ready" if ready else "not ready", **checks}, status=200 if ready else 503)
+
+async def handle_metrics(request):
+    return web.Response(text=prometheus_text(collect_metrics()), content_type="text/plain", charset="utf-8")
+
+async def start_health_server():
+    """Serve /, /healthz, /readyz and /metrics from the bot's own event loop."""
+    app = web.Application()
+    app.router.add_get("/", handle_home)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+    return runner
 
 # ==========================================
 # 🤖 BOT SETUP
 # ==========================================
+class PrefixTrie:
+    """Character trie over one guild's prefixes, including the bot's mention forms."""
+    __slots__ = ("root", "prefixes")
+    END = ""   # never a real character, so it can mark where a prefix ends
+
+    def __init__(self, prefixes):
+        self.prefixes = sorted(dict.fromkeys(prefixes), key=len, reverse=True)   # discord.py takes the first that fits
+        self.root = {}
+        for prefix in self.prefixes:
+            node = self.root
+            for ch in prefix: node = node.setdefault(ch, {})
+            node[self.END] = prefix
+
+    def match(self, content):
+        """Longest prefix that `content` starts with, or None. Stops at the first character no prefix shares."""
+        node, found = self.root, None
+        for ch in content:
+            node = node.get(ch)
+            if node is None: break
+            if self.END in node: found = node[self.END]
+        return found
+
+prefix_tables = {}   # guild_id (None for DMs) -> PrefixTrie, dropped by set_config
+
+def guild_prefixes(guild_id):
+    return guild_config(guild_id).prefixes if guild_id is not None else [DEFAULT_PREFIX]
+
+def prefix_table(guild_id):
+    table = prefix_tables.get(guild_id)
+    if table is None:
+        mentions = [f"<@{bot.user.id}> ", f"<@!{bot.user.id}> "] if bot.user else []
+        table = PrefixTrie(guild_prefixes(guild_id) + mentions)
+        if bot.user: prefix_tables[guild_id] = table   # mention forms are only known once logged in
+    return table
+
 def get_prefix(bot, message):
-    if not message.guild:
-        return DEFAULT_PREFIX
-    guild_config = get_guild_data(config_db, message.guild.id)
-    return guild_config.get("prefix", DEFAULT_PREFIX)
+    return prefix_table(message.guild.id if message.guild else None).prefixes
+
+def display_prefix(message):
+    return guild_prefixes(message.guild.id if message.guild else None)[0]
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -51,6 +274,17 @@ intents.guilds = True
 bot = commands.Bot(command_prefix=get_prefix, intents=intents, help_command=None)
 
 # === DATABASE HANDLING (GUILD-SPECIFIC) ===
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()   # "json" or "sqlite"
+SQLITE_PATH = os.getenv("SQLITE_PATH", "queen.db")
+DATA_DIR = os.getenv("DATA_DIR", "data")                     # per-guild shards for the JSON backend
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))     # seconds between background flushes
+FLUSH_THRESHOLD = int(os.getenv("FLUSH_THRESHOLD", "500"))   # mutations that trigger an early flush
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "300"))     # seconds between journal compactions
+COMPACT_BYTES = int(os.getenv("COMPACT_BYTES", str(256 * 1024)))   # per-guild journal size that forces a compaction
+GUILD_CACHE_MB = float(os.getenv("GUILD_CACHE_MB", "256"))         # memory budget for resident guild data
+STORE_FILES = {"warnings": "warnings.json", "levels": "levels.json", "money": "money.json", "config": "config.json", "reminders": "reminders.json", "tempactions": "tempactions.json"}
+ROW_BYTES = {"warnings": 640, "config": 120, "reminders": 220, "tempactions": 120}   # rough resident cost of one row in the dict-backed stores
+
 def load_json(filename):
     if os.path.exists(filename):
         try:
@@ -58,55 +292,2172 @@ def load_json(filename):
         except (json.JSONDecodeError, IOError): return {}
     return {}
 
-def save_json(filename, data):
+def write_json_atomic(filename, text):
+    # Write to a temp file and swap it in, so a crash mid-write never truncates the real file.
+    tmp = f"{filename}.{get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+def read_journal(path):
+    """(entries, size in bytes) of a journal file, after repairing it.
+
+    A crash mid-append leaves a torn last line with no newline. That line is
+    truncated away so the next append starts on a fresh line instead of
+    running on from the fragment. Any other unreadable line is skipped, not
+    treated as the end of the journal.
+    """
+    if not os.path.exists(path): return [], 0
+    with open(path, "rb") as f: raw = f.read()
+    end = raw.rfind(b"\n") + 1
+    if end < len(raw):
+        with open(path, "r+b") as f:
+            f.truncate(end)
+            f.flush(); os.fsync(f.fileno())
+        print(f"Truncated a torn {len(raw) - end}-byte entry from {path}")
+    entries, skipped = [], 0
+    for line in raw[:end].splitlines():
+        if not line.strip(): continue
+        try: entry = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError): entry = None
+        if isinstance(entry, list): entries.append(entry)
+        else: skipped += 1
+    if skipped: print(f"Skipped {skipped} unreadable lines in {path}")
+    return entries, end
+
+def replay_journal(path, data):
+    entries, size = read_journal(path)
+    for entry in entries:
+        if not entry: data.clear()
+        elif len(entry) == 1: data.pop(entry[0], None)
+        else: data[entry[0]] = entry[1]
+    return size
+
+class JsonBackend:
+    """Per-guild JSON shards, each a snapshot plus an append-only mutation journal.
+
+    `data/<store>/<guild>.json` holds the snapshot and every flush appends one
+    line per dirty row to `<guild>.journal`: `[key, value]` sets a row, `[key]`
+    deletes it and `[]` wipes the guild. A journal is compacted into its
+    snapshot (swapped in atomically) on an interval, past a size threshold and
+    when the guild is evicted; loading a guild replays snapshot plus journal.
+    """
+    name = "json"
+    point_reads = False
+
+    def __init__(self, root=DATA_DIR, compact_interval=COMPACT_INTERVAL, compact_bytes=COMPACT_BYTES):
+        self.root = root
+        self.compact_interval, self.compact_bytes = compact_interval, compact_bytes
+        self.journal_bytes = {}   # (store, guild_id) -> bytes appended since the last compaction
+        self.compacted_at = {}    # (store, guild_id) -> monotonic time of the last compaction
+        self.torn = set()         # (store, guild_id) whose last append failed partway and may have left a fragment
+        self.compactions = 0
+        for store in STORE_FILES: self.migrate_legacy(store)
+
+    def path(self, store, guild_id, ext):
+        if not guild_id.isdigit(): raise ValueError(f"Invalid guild id {guild_id!r}")
+        return os.path.join(self.root, store, f"{guild_id}.{ext}")
+
+    def migrate_legacy(self, store):
+        # One-shot split of the old whole-store file (and its journal) into per-guild shards.
+        folder = os.path.join(self.root, store)
+        marker = os.path.join(folder, ".migrated")
+        if os.path.exists(marker): return
+        os.makedirs(folder, exist_ok=True)
+        legacy = load_json(STORE_FILES[store])
+        journal = STORE_FILES[store].rsplit(".", 1)[0] + ".journal"
+        for entry in read_journal(journal)[0]:
+            if len(entry) == 1: legacy.pop(entry[0], None)
+            elif len(entry) == 2: legacy.get(entry[0], {}).pop(entry[1], None)
+            elif len(entry) == 3: legacy.setdefault(entry[0], {})[entry[1]] = entry[2]
+        shards = {str(guild_id): guild for guild_id, guild in legacy.items() if isinstance(guild, dict) and str(guild_id).isdigit()}
+        for guild_id, guild in shards.items():
+            write_json_atomic(self.path(store, guild_id, "json"), json.dumps(guild, ensure_ascii=False))
+        with open(marker, "w", encoding="utf-8") as f: f.write(datetime.now().isoformat())
+        if shards: print(f"Split {STORE_FILES[store]} into {len(shards)} guild shards under {folder}")
+
+    def load_guild(self, store, guild_id):
+        data = load_json(self.path(store, guild_id, "json"))
+        if size := replay_journal(self.path(store, guild_id, "journal"), data):
+            self.journal_bytes[(store, guild_id)] = size
+            self.compacted_at[(store, guild_id)] = 0.0  # fold replayed entries in on the next flush
+        return data
+
+    def load_all(self, store):
+        folder = os.path.join(self.root, store)
+        guild_ids = {name.split(".")[0] for name in os.listdir(folder) if name[0].isdigit()} if os.path.isdir(folder) else ()
+        return {guild_id: guild for guild_id in guild_ids if (guild := self.load_guild(store, guild_id))}
+
+    def get_row(self, store, guild_id, key, default=None):
+        return self.load_guild(store, guild_id).get(key, default)
+
+    def prepare(self, db, rows):
+        shards = []
+        for guild_id, keys in rows.items():
+            guild, lines = dict.get(db, guild_id), []
+            if keys is None:
+                lines.append([])
+                keys = guild or ()
+            elif guild is None:
+                # Eviction skips guilds with dirty rows, so this means a write was lost; say so instead of dropping it quietly.
+                print(f"Error saving {db.name}/{guild_id}: {len(keys)} dirty rows but the guild is no longer resident")
+                continue
+            for key in keys:
+                lines.append([key, guild[key]] if key in guild else [key])
+            text = "".join(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n" for line in lines)
+            shards.append((guild_id, text, len(lines)))
+        return db.name, shards
+
+    def commit(self, payload):
+        store, shards = payload
+        written = 0
+        for guild_id, text, count in shards:
+            key = (store, guild_id)
+            if key in self.torn: text = "\n" + text   # don't run on from a fragment a failed append left behind
+            try:
+                with open(self.path(store, guild_id, "journal"), "a", encoding="utf-8") as f:
+                    f.write(text)
+                    f.flush(); os.fsync(f.fileno())
+            except OSError:
+                self.torn.add(key)
+                raise
+            self.torn.discard(key)
+            self.journal_bytes[key] = self.journal_bytes.get(key, 0) + len(text.encode("utf-8"))
+            self.compacted_at.setdefault(key, time.monotonic())
+            written += count
+        return written
+
+    def due_snapshots(self, dbs):
+        now = time.monotonic()
+        return [
+            (dbs[store], guild_id) for (store, guild_id), size in self.journal_bytes.items()
+            if size and store in dbs and guild_id in dbs[store]
+            and (size >= self.compact_bytes or now - self.compacted_at.get((store, guild_id), 0.0) >= self.compact_interval)
+        ]
+
+    def prepare_snapshot(self, db, guild_id):
+        # Called with no journal appends in flight, so the snapshot covers every journaled line.
+        return db.name, guild_id, json.dumps(guild_rows(dict.get(db, guild_id, {})), ensure_ascii=False)
+
+    def commit_snapshot(self, payload):
+        store, guild_id, text = payload
+        snapshot, journal = self.path(store, guild_id, "json"), self.path(store, guild_id, "journal")
+        if text == "{}":
+            for path in (snapshot, journal):
+                if os.path.exists(path): os.remove(path)
+        else:
+            write_json_atomic(snapshot, text)
+            # A crash between these two steps only replays rows the snapshot already holds.
+            with open(journal, "w", encoding="utf-8"): pass
+        self.journal_bytes.pop((store, guild_id), None)
+        self.compacted_at.pop((store, guild_id), None)
+        self.compactions += 1
+
+    def needs_snapshot(self, store, guild_id):
+        # An evicted guild can't be snapshotted from memory later, so its journal is folded in first.
+        return bool(self.journal_bytes.get((store, guild_id)))
+
+class SqliteBackend:
+    """One row per (store, guild, key) in a WAL-mode SQLite file.
+
+    Flushes become single-row upserts/deletes and point reads go through the
+    primary-key index, so neither scales with the number of guilds.
+    """
+    name = "sqlite"
+    point_reads = True
+    compactions = 0
+
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = Lock()
+        self.writer = self._connect()
+        self.reader = self._connect()
+        self.writer.executescript(
+            "CREATE TABLE IF NOT EXISTS records (store TEXT NOT NULL, guild_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (store, guild_id, key)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        )
+        self.migrate_from_json()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def migrate_from_json(self):
+        # One-shot import of the JSON data, recorded in `meta` so it never runs twice.
+        if self.writer.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone(): return
+        source = JsonBackend()
+        rows = [
+            (store, guild_id, str(key), json.dumps(value, ensure_ascii=False))
+            for store in STORE_FILES
+            for guild_id, guild in source.load_all(store).items()
+            for key, value in guild.items()
+        ]
+        with self._write_lock:
+            self.writer.execute("BEGIN")
+            self.writer.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", rows)
+            self.writer.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+            self.writer.execute("COMMIT")
+        if rows: print(f"Migrated {len(rows)} records from JSON into {self.path}")
+
+    def load_all(self, store):
+        data = {}
+        for guild_id, key, value in self.reader.execute("SELECT guild_id, key, value FROM records WHERE store = ?", (store,)):
+            data.setdefault(guild_id, {})[key] = json.loads(value)
+        return data
+
+    def load_guild(self, store, guild_id):
+        cur = self.reader.execute("SELECT key, value FROM records WHERE store = ? AND guild_id = ?", (store, guild_id))
+        return {key: json.loads(value) for key, value in cur}
+
+    def get_row(self, store, guild_id, key, default=None):
+        row = self.reader.execute("SELECT value FROM records WHERE store = ? AND guild_id = ? AND key = ?", (store, guild_id, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def xp_rank(self, guild_id, user_id, total):
+        """(1-based leaderboard position, ranked users) for a guild that isn't resident, counted in place."""
+        # Rows from before level curves carry level/xp on the default curve instead of total_xp.
+        above, count = self.reader.execute(
+            "SELECT COALESCE(SUM(t > ? OR (t = ? AND uid < ?)), 0), COUNT(*) FROM (SELECT CAST(key AS INTEGER) AS uid,"
+            " COALESCE(json_extract(value, '$.total_xp'), (json_extract(value, '$.level') - 1) * 100"
+            " + 50 * (json_extract(value, '$.level') - 1) * (json_extract(value, '$.level') - 2) + COALESCE(json_extract(value, '$.xp'), 0)) AS t"
+            " FROM records WHERE store = 'levels' AND guild_id = ?)", (total, total, int(user_id), guild_id)).fetchone()
+        return above + 1, count
+
+    def prepare(self, db, rows):
+        upserts, deletes, wipes = [], [], []
+        for guild_id, keys in rows.items():
+            guild = dict.get(db, guild_id)
+            if keys is None:
+                wipes.append((db.name, guild_id))
+                keys = guild or ()
+            elif guild is None:
+                print(f"Error saving {db.name}/{guild_id}: {len(keys)} dirty rows but the guild is no longer resident")
+                continue
+            for key in keys:
+                if key in guild: upserts.append((db.name, guild_id, key, json.dumps(guild[key], ensure_ascii=False)))
+                else: deletes.append((db.name, guild_id, key))
+        return upserts, deletes, wipes
+
+    def commit(self, payload):
+        upserts, deletes, wipes = payload
+        with self._write_lock:
+            self.writer.execute("BEGIN")
+            try:
+                self.writer.executemany("DELETE FROM records WHERE store = ? AND guild_id = ?", wipes)
+                self.writer.executemany("DELETE FROM records WHERE store = ? AND guild_id = ? AND key = ?", deletes)
+                self.writer.executemany("INSERT INTO records VALUES (?, ?, ?, ?) ON CONFLICT (store, guild_id, key) DO UPDATE SET value = excluded.value", upserts)
+                self.writer.execute("COMMIT")
+            except sqlite3.Error:
+                self.writer.execute("ROLLBACK")
+                raise
+        return len(upserts) + len(deletes) + len(wipes)
+
+    def due_snapshots(self, dbs):
+        return []  # SQLite's own WAL checkpointing covers this
+
+    def needs_snapshot(self, store, guild_id):
+        return False
+
+class GuildDB(dict):
+    """guild_id -> {key: value} for one store.
+
+    Guilds are loaded from the backend on first access and tracked by the
+    shared LRU cache, which evicts the coldest ones once the memory budget is
+    exceeded.
+    """
+    def __init__(self, name, table=None, on_load=None):
+        super().__init__()
+        self.name = name
+        self.table = table       # CompactTable subclass for typed stores, None for plain dicts
+        self.on_load = on_load   # called with (guild_id, guild) after a guild is loaded
+        persistence.dbs[name] = self
+
+    def __getitem__(self, guild_id):
+        guild = dict.get(self, guild_id)
+        if guild is None:
+            guild = storage.load_guild(self.name, guild_id)
+            if self.table: guild = self.table.from_rows(guild)
+            if self.on_load: self.on_load(guild_id, guild)
+            dict.__setitem__(self, guild_id, guild)
+            guild_cache.admit(self, guild_id)
+        else: guild_cache.touch(self, guild_id)
+        return guild
+
+    def pop(self, guild_id, *default):
+        guild_cache.forget(self, guild_id)
+        return dict.pop(self, guild_id, *default)
+
+    def reset(self, guild_id):
+        """Replace a guild with an empty resident one and queue the wipe.
+
+        The empty guild stays resident (the pending wipe keeps it from being
+        evicted), so a read before the flush can't load the old rows back in.
+        """
+        guild = self.table() if self.table else {}
+        if self.on_load: self.on_load(guild_id, guild)
+        self.pop(guild_id, None)
+        dict.__setitem__(self, guild_id, guild)
+        guild_cache.admit(self, guild_id)
+        persistence.mark_dirty(self, guild_id)
+        return guild
+
+class GuildCache:
+    """LRU over every resident (store, guild) pair, bounded by an estimated byte budget."""
+    def __init__(self, budget_mb=GUILD_CACHE_MB):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.entries = OrderedDict()   # (store name, guild_id) -> estimated bytes
+        self.total = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def estimate(store, guild_id):
+        guild = dict.get(persistence.dbs[store], guild_id, ())
+        if isinstance(guild, CompactTable): return 232 + guild.nbytes()
+        return 232 + len(guild) * ROW_BYTES.get(store, 256)
+
+    def touch(self, db, guild_id):
+        try: self.entries.move_to_end((db.name, guild_id))
+        except KeyError: self.admit(db, guild_id)
+
+    def admit(self, db, guild_id):
+        # Eviction does I/O, so it never runs here on the read path; the flush task does it.
+        size = self.entries[(db.name, guild_id)] = self.estimate(db.name, guild_id)
+        self.total += size
+        self.loads += 1
+        if self.total > self.budget: persistence.wake()
+
+    def forget(self, db, guild_id):
+        self.total -= self.entries.pop((db.name, guild_id), 0)
+
+    def rebalance(self):
+        # Rows are added to resident guilds without going through the cache, so re-estimate periodically.
+        for key in self.entries: self.entries[key] = self.estimate(*key)
+        self.total = sum(self.entries.values())
+
+    @staticmethod
+    def evictable(store, guild_id):
+        # Not while rows are waiting to be written, and not while a caller still holds the guild (say across an
+        # await): dropping it then would leave that caller's later mark_dirty pointing at nothing.
+        if guild_id in persistence.dirty.get(store, ()): return False
+        return sys.getrefcount(dict.get(persistence.dbs[store], guild_id)) <= 2   # the GuildDB's own reference + the argument
+
+    async def evict(self):
+        """Drop the coldest clean, unused guilds until back under budget. Runs in the flush task, under its lock."""
+        victims, freed, newest = [], 0, next(reversed(self.entries), None)
+        for key, size in self.entries.items():
+            if self.total - freed <= self.budget: break
+            if key != newest and self.evictable(*key):   # never the guild that was just used
+                victims.append(key)
+                freed += size
+        backend = persistence.backend
+        snapshots = [backend.prepare_snapshot(persistence.dbs[store], guild_id) for store, guild_id in victims if backend.needs_snapshot(store, guild_id)]
+        failed = await asyncio.to_thread(persistence._write_snapshots, snapshots) if snapshots else set()
+        for key in victims:
+            # Anything dirtied or picked up again while the snapshots were written stays resident.
+            if key in failed or key not in self.entries or not self.evictable(*key): continue
+            store, guild_id = key
+            dict.pop(persistence.dbs[store], guild_id, None)
+            self.total -= self.entries.pop(key)
+            self.evictions += 1
+
+    def summary(self):
+        return f"{len(self.entries)} resident guild stores · ~{self.total / 1048576:.1f}/{self.budget / 1048576:.0f} MB · {self.evictions} evicted"
+
+async def wait_event(event, timeout):
+    """Wait for `event` for up to `timeout` seconds (None = forever). True if it fired.
+
+    asyncio.wait_for can swallow a cancellation that races with the event
+    being set (Python 3.11), which leaves a background loop running through
+    shutdown; asyncio.timeout never does.
+    """
     try:
-        with open(filename, "w", encoding="utf-8") as f: json.dump(data, f, indent=4, ensure_ascii=False)
-    except IOError as e: print(f"Error saving {filename}: {e}")
-
-warnings_db = load_json("warnings.json")
-levels_db = load_json("levels.json")
-money_db = load_json("money.json")
-config_db = load_json("config.json")
-xp_cooldowns = {}
+        async with asyncio.timeout(timeout): await event.wait()
+        return True
+    except TimeoutError: return False
+
+class PersistenceEngine:
+    """Write-behind layer in front of the storage backend.
+
+    Commands only mark the rows they touched as dirty; repeated changes to the
+    same row between flushes collapse into one write. A background task hands
+    the dirty rows to the backend once per interval (or sooner once `threshold`
+    mutations pile up) and does the I/O off the event loop.
+    """
+    def __init__(self, backend, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.backend = backend
+        self.interval, self.threshold = interval, threshold
+        self.dbs = {}            # store name -> GuildDB
+        self.dirty = {}          # store name -> {guild_id: set of keys, or None for the whole guild}
+        self.pending = 0         # mutations merged since the last flush
+        self.flushes = 0
+        self.rows_written = 0
+        self.merged = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self._wake = None
+        self._lock = None
+        self._task = None
+
+    def mark_dirty(self, db, guild_id, key=None):
+        rows = self.dirty.setdefault(db.name, {})
+        guild_id = str(guild_id)
+        if key is None: rows[guild_id] = None
+        elif guild_id not in rows: rows[guild_id] = {str(key)}
+        elif rows[guild_id] is not None:
+            if str(key) in rows[guild_id]: self.merged += 1
+            rows[guild_id].add(str(key))
+        else: self.merged += 1
+        self.pending += 1
+        if self._wake and self.pending >= self.threshold: self._wake.set()
+
+    def _take_batch(self):
+        # Serialize on the loop thread so the writer never sees a dict mid-mutation.
+        batch, self.dirty, self.pending = self.dirty, {}, 0
+        return [(name, rows, self.backend.prepare(self.dbs[name], rows)) for name, rows in batch.items()]
+
+    def _write_batch(self, prepared):
+        written, failed = 0, []
+        for name, rows, payload in prepared:
+            try: written += self.backend.commit(payload)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error saving {name}: {e}")
+                failed.append((name, rows))
+        return written, failed
+
+    def _record(self, started, result):
+        written, failed = result
+        for name, rows in failed:
+            # Re-queue the rows; anything dirtied since then already covers its own keys.
+            current = self.dirty.setdefault(name, {})
+            for guild_id, keys in rows.items():
+                if keys is None or current.get(guild_id, set()) is None: current[guild_id] = None
+                else: current[guild_id] = current.get(guild_id, set()) | keys
+        elapsed = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.rows_written += written
+        self.errors += len(failed)
+        self.total_ms += elapsed
+        self.last_ms = elapsed
+        self.max_ms = max(self.max_ms, elapsed)
+
+    def _take_snapshots(self):
+        return [self.backend.prepare_snapshot(db, guild_id) for db, guild_id in self.backend.due_snapshots(self.dbs)]
+
+    def _write_snapshots(self, snapshots):
+        failed = set()
+        for payload in snapshots:
+            try: self.backend.commit_snapshot(payload)
+            except OSError as e:
+                print(f"Error compacting {payload[0]}/{payload[1]}: {e}")
+                self.errors += 1
+                failed.add((payload[0], payload[1]))
+        return failed
+
+    async def flush(self):
+        async with self._lock:
+            if self.dirty:
+                started = time.perf_counter()
+                prepared = self._take_batch()
+                self._record(started, await asyncio.to_thread(self._write_batch, prepared))
+            if snapshots := self._take_snapshots():
+                await asyncio.to_thread(self._write_snapshots, snapshots)
+            guild_cache.rebalance()
+            if guild_cache.total > guild_cache.budget: await guild_cache.evict()
+
+    def wake(self):
+        if self._wake: self._wake.set()
+
+    def flush_sync(self):
+        """Blocking flush for shutdown, when the loop is no longer running."""
+        if self.dirty:
+            started = time.perf_counter()
+            self._record(started, self._write_batch(self._take_batch()))
+
+    async def _run(self):
+        try:
+            while True:
+                await wait_event(self._wake, self.interval)
+                self._wake.clear()
+                await self.flush()
+        finally: self.flush_sync()
+
+    def start(self):
+        if self._task: return
+        self._wake, self._lock = asyncio.Event(), asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    def summary(self):
+        avg = self.total_ms / self.flushes if self.flushes else 0.0
+        dirty_rows = sum(len(rows) for rows in self.dirty.values())
+        return f"`{self.backend.name}` · {self.flushes} flushes ({self.rows_written} writes, {self.merged} merged)\nlast {self.last_ms:.1f}ms · avg {avg:.1f}ms · max {self.max_ms:.1f}ms\n{dirty_rows} dirty guilds · {self.backend.compactions} compactions · {self.errors} errors"
+
+# === COMPACT USER TABLES ===
+class RankIndex:
+    """Leaderboard order as two parallel arrays: totals descending, ties broken by ascending user ID.
+
+    Built with one sort, it costs 16 bytes per user and finds a position by
+    bisection. Gaining XP moves a user a short way up the board, so an update
+    shifts only the entries between the old and new position.
+    """
+    __slots__ = ("neg", "ids")
+
+    def __init__(self, totals=(), ids=()):
+        # `ids` ascend, and a reverse sort is still stable, so equal totals stay in user ID order.
+        order = sorted(range(len(ids)), key=totals.__getitem__, reverse=True)
+        self.neg = array("q", (-totals[slot] for slot in order))
+        self.ids = array("q", (ids[slot] for slot in order))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, total, user_id):
+        """Number of entries ranked above (total, user_id): its 0-based position when present."""
+        lo = bisect_left(self.neg, -total)
+        return bisect_left(self.ids, user_id, lo, bisect_right(self.neg, -total, lo))
+
+    def insert(self, total, user_id):
+        at = self.position(total, user_id)
+        self.neg.insert(at, -total)
+        self.ids.insert(at, user_id)
+
+    def remove(self, total, user_id):
+        at = self.position(total, user_id)
+        if at >= len(self.ids) or self.ids[at] != user_id: raise KeyError(user_id)
+        del self.neg[at], self.ids[at]
+
+    def move(self, old, new, user_id):
+        start, end = self.position(old, user_id), self.position(new, user_id)
+        if end > start:
+            end -= 1   # positions past the old entry close up once it leaves
+            self.neg[start:end], self.ids[start:end] = self.neg[start + 1:end + 1], self.ids[start + 1:end + 1]
+        elif end < start:
+            self.neg[end + 1:start + 1], self.ids[end + 1:start + 1] = self.neg[end:start], self.ids[end:start]
+        self.neg[end], self.ids[end] = -new, user_id
+
+    def slice(self, start, count):
+        """[(total, user_id)] at positions start .. start+count-1."""
+        return [(-neg, uid) for neg, uid in zip(self.neg[start:start + count], self.ids[start:start + count])]
+
+    def nbytes(self):
+        return sys.getsizeof(self.neg) + sys.getsizeof(self.ids)
+
+INT64_MAX = 2**63 - 1
+MAX_AMOUNT = 10**15   # largest XP/coin amount a command accepts, far below the tables' 64-bit ceiling
+MAX_LEVEL = 1_000_000
+
+def clamp_int64(value):
+    # The `q` columns can't hold more; saturate instead of raising OverflowError mid-update.
+    return min(max(value, -INT64_MAX), INT64_MAX)
+
+class CompactTable:
+    """Per-guild user rows stored column-wise in typed arrays, keyed by integer user ID.
+
+    User IDs live in a sorted `q` array found by bisection, so a row costs a few
+    machine words and no per-user Python objects at all. Lookups are O(log n);
+    a brand-new user is an O(n) memmove, which is rare next to lookups. The
+    mapping methods (`get`, `in`, iteration, `[]`) speak the on-disk row format
+    so the storage backends can treat tables like dicts.
+    """
+    __slots__ = ("ids", "cols")
+    COLUMNS = ()   # (typecode, default) per column
+
+    def __init__(self):
+        self.ids = array("q")
+        self.cols = tuple(array(typecode) for typecode, _ in self.COLUMNS)
+
+    @classmethod
+    def from_rows(cls, rows):
+        table = cls()
+        decoded = sorted((int(key), values) for key, value in rows.items() if str(key).isdigit() and (values := cls.decode(value)) is not None)
+        table.ids.extend(uid for uid, _ in decoded)
+        for i, col in enumerate(table.cols): col.extend(clamp_int64(values[i]) for _, values in decoded)
+        return table
+
+    def to_rows(self):
+        return {str(uid): self.encode(slot) for slot, uid in enumerate(self.ids)}
+
+    def slot(self, user_id):
+        user_id = int(user_id)
+        slot = bisect_left(self.ids, user_id)
+        return slot if slot < len(self.ids) and self.ids[slot] == user_id else -1
+
+    def put(self, user_id, *values):
+        user_id, values = int(user_id), [clamp_int64(value) for value in values]
+        slot = bisect_left(self.ids, user_id)
+        if slot < len(self.ids) and self.ids[slot] == user_id:
+            for col, value in zip(self.cols, values): col[slot] = value
+        else:
+            self.ids.insert(slot, user_id)
+            for col, value in zip(self.cols, values): col.insert(slot, value)
+        return slot
+
+    def __delitem__(self, user_id):
+        slot = self.slot(user_id)
+        if slot < 0: raise KeyError(user_id)
+        del self.ids[slot]
+        for col in self.cols: del col[slot]
+
+    def __contains__(self, user_id):
+        return str(user_id).isdigit() and self.slot(user_id) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (str(uid) for uid in self.ids)
+
+    def __getitem__(self, user_id):
+        slot = self.slot(user_id)
+        if slot < 0: raise KeyError(user_id)
+        return self.encode(slot)
+
+    def get(self, user_id, default=None):
+        slot = self.slot(user_id) if str(user_id).isdigit() else -1
+        return default if slot < 0 else self.encode(slot)
+
+    def nbytes(self):
+        return sys.getsizeof(self.ids) + sum(sys.getsizeof(col) for col in self.cols)
+
+class LevelCurve:
+    """XP needed to go from level L to L+1 is `base + step * (L - 1)`; the default (100, 100) is the classic `L * 100`.
+
+    Levels are derived from total XP: by bisection over a precomputed table of
+    cumulative thresholds for the first TABLE_LEVELS levels, and by solving the
+    quadratic exactly beyond that. Either way it is O(1)-ish, not a loop per level.
+    """
+    __slots__ = ("base", "step", "thresholds")
+    TABLE_LEVELS = 1024
+
+    def __init__(self, base=100, step=100):
+        self.base, self.step = base, step
+        self.thresholds = array("q", (self.total_for(level) for level in range(1, self.TABLE_LEVELS + 1)))
+
+    def total_for(self, level):
+        """Total XP at which `level` is reached (level 1 starts at 0)."""
+        n = level - 1
+        return n * self.base + self.step * n * (n - 1) // 2
+
+    def level_for(self, total):
+        if total < self.thresholds[-1]: return bisect_right(self.thresholds, total)
+        if self.step == 0: return total // self.base + 1
+        # n = levels gained: largest n with step*n^2 + (2*base - step)*n <= 2*total
+        b = 2 * self.base - self.step
+        n = (isqrt(b * b + 8 * self.step * total) - b) // (2 * self.step)
+        while self.total_for(n + 2) <= total: n += 1
+        while n > 0 and self.total_for(n + 1) > total: n -= 1
+        return n + 1
+
+    def needed(self, level):
+        return self.base + self.step * (level - 1)
+
+    def progress(self, total):
+        """(level, xp into that level, xp that level needs)."""
+        level = self.level_for(total)
+        return level, total - self.total_for(level), self.needed(level)
+
+DEFAULT_CURVE = LevelCurve()
+level_curves = {(100, 100): DEFAULT_CURVE}   # (base, step) -> shared LevelCurve
+
+def level_curve(guild_id):
+    base, step = guild_config(guild_id).level_curve
+    if (base, step) not in level_curves: level_curves[(base, step)] = LevelCurve(base, step)
+    return level_curves[(base, step)]
+
+class LevelTable(CompactTable):
+    """Total XP per user (levels are derived through the guild's curve), plus a rank index built on first use."""
+    __slots__ = ("ranking", "curve")
+    COLUMNS = (("q", 0),)   # total xp
+
+    def __init__(self):
+        super().__init__()
+        self.ranking = None
+        self.curve = DEFAULT_CURVE
+
+    @staticmethod
+    def decode(value):
+        if not isinstance(value, dict): return None
+        if "total_xp" in value: return (int(value["total_xp"]),)
+        # Rows written before curves existed always used the default curve.
+        return (DEFAULT_CURVE.total_for(int(value.get("level", 1))) + int(value.get("xp", 0)),)
+
+    def encode(self, slot):
+        return {"total_xp": self.cols[0][slot]}
+
+    def put(self, user_id, *values):
+        slot = self.slot(user_id)
+        old = self.cols[0][slot] if slot >= 0 else None
+        slot = super().put(user_id, *values)
+        if self.ranking is not None:
+            if old is None: self.ranking.insert(self.cols[0][slot], self.ids[slot])
+            else: self.ranking.move(old, self.cols[0][slot], self.ids[slot])
+        return slot
+
+    def __delitem__(self, user_id):
+        if self.ranking is not None and (slot := self.slot(user_id)) >= 0: self.ranking.remove(self.cols[0][slot], self.ids[slot])
+        super().__delitem__(user_id)
+
+    def total(self, user_id):
+        slot = self.slot(user_id)
+        return 0 if slot < 0 else self.cols[0][slot]
+
+    def set_level(self, user_id, level):
+        self.put(user_id, self.curve.total_for(level))
+
+    def add_xp(self, user_id, amount):
+        """Add XP and return (old level, new level)."""
+        slot = self.slot(user_id)
+        if slot < 0:
+            self.put(user_id, amount)
+            return 1, self.curve.level_for(amount)
+        old_total = self.cols[0][slot]
+        new_total = self.cols[0][slot] = clamp_int64(old_total + amount)
+        if self.ranking is not None: self.ranking.move(old_total, new_total, self.ids[slot])
+        return self.curve.level_for(old_total), self.curve.level_for(new_total)
+
+    def ranked(self):
+        if self.ranking is None: self.ranking = RankIndex(self.cols[0], self.ids)
+        return self.ranking
+
+    def rank_of(self, user_id):
+        """1-based leaderboard position, or None for users with no XP row."""
+        slot = self.slot(user_id)
+        return None if slot < 0 else self.ranked().position(self.cols[0][slot], self.ids[slot]) + 1
+
+    def page(self, start, count):
+        """[(user_id, xp into level, level)] for ranks start+1 .. start+count."""
+        rows = []
+        for total, uid in self.ranked().slice(start, count):
+            level, xp, _ = self.curve.progress(total)
+            rows.append((uid, xp, level))
+        return rows
+
+    def nbytes(self):
+        return super().nbytes() + (self.ranking.nbytes() if self.ranking is not None else 0)
+
+    def top(self, n=10):
+        return self.page(0, n)
+
+class BalanceTable(CompactTable):
+    __slots__ = ()
+    COLUMNS = (("q", 0),)   # balance
+
+    @staticmethod
+    def decode(value):
+        return (int(value),) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    def encode(self, slot):
+        return self.cols[0][slot]
+
+    def balance(self, user_id):
+        slot = self.slot(user_id)
+        return 0 if slot < 0 else self.cols[0][slot]
+
+    def set_balance(self, user_id, amount):
+        self.put(user_id, amount)
+
+    def add(self, user_id, amount):
+        """Add `amount` (negative to take) and return the new balance."""
+        slot = self.slot(user_id)
+        if slot < 0: slot = self.put(user_id, amount)
+        else: self.cols[0][slot] = clamp_int64(self.cols[0][slot] + amount)
+        return self.cols[0][slot]
+
+    def top(self, n=10):
+        balances = self.cols[0]
+        return [(self.ids[slot], balances[slot]) for slot in heapq.nlargest(n, range(len(self.ids)), key=balances.__getitem__)]
+
+def guild_rows(guild):
+    return guild.to_rows() if isinstance(guild, CompactTable) else guild
+
+storage = SqliteBackend(SQLITE_PATH) if STORAGE_BACKEND == "sqlite" else JsonBackend()
+persistence = PersistenceEngine(storage)
+guild_cache = GuildCache()
+
+def mark_dirty(db, guild_id, key=None):
+    persistence.mark_dirty(db, guild_id, key)
+
+warnings_db = GuildDB("warnings")
+levels_db = GuildDB("levels", LevelTable, on_load=lambda guild_id, table: setattr(table, "curve", level_curve(guild_id)))
+money_db = GuildDB("money", BalanceTable)
+config_db = GuildDB("config")
+reminders_db = GuildDB("reminders")   # reminder id -> {"user", "channel", "due", "text"[, "attempts"]}
+temp_actions_db = GuildDB("tempactions")   # "mute:<user>" / "ban:<user>" -> {"until", "reason"[, "attempts"]}
 
 def get_guild_data(db, guild_id):
+    return db[str(guild_id)]
+
+def read_row(db, guild_id, key, default=None):
+    # Read paths never create rows: resident guilds answer from memory, others via an indexed
+    # lookup where the backend has one, or by loading the guild into the cache where it doesn't.
+    guild_id = str(guild_id)
+    if guild_id in db or not storage.point_reads: return db[guild_id].get(str(key), default)
+    return storage.get_row(db.name, guild_id, str(key), default)
+
+async def xp_rank(guild_id, user_id, total):
+    """(1-based leaderboard position, ranked users). Resident guilds use their rank index; others are counted by the backend off the loop."""
     guild_id = str(guild_id)
-    if guild_id not in db: db[guild_id] = {}
-    return db[guild_id]
+    if guild_id in levels_db or not storage.point_reads:
+        table = levels_db[guild_id]
+        return table.rank_of(user_id), len(table)
+    return await asyncio.to_thread(storage.xp_rank, guild_id, user_id, total)
+
+# === XP COOLDOWNS ===
+class CooldownWheel:
+    """Per-(guild, member) cooldowns that reclaim themselves once they expire.
+
+    Keys are the guild and user snowflakes packed into one int. Each armed
+    cooldown is also dropped into a one-second timing-wheel slot for its expiry
+    second; every check sweeps the slots that have fully elapsed since the last
+    one, so stale members cost O(1) amortized to forget instead of living for
+    the life of the process.
+    """
+    __slots__ = ("expiry", "slots", "horizon", "cursor", "reclaimed")
+
+    def __init__(self, horizon=512, now=None):
+        self.expiry = {}   # packed key -> monotonic expiry time
+        self.slots = [[] for _ in range(horizon)]
+        self.horizon = horizon
+        self.cursor = int(time.monotonic() if now is None else now)   # every second before this one has been swept
+        self.reclaimed = 0
+
+    @staticmethod
+    def pack(guild_id, user_id):
+        return (guild_id << 64) | user_id
+
+    def _sweep(self, now):
+        second = int(now)
+        if second - self.cursor >= self.horizon:   # idle for a whole lap: every slot has expired
+            self.reclaimed += len(self.expiry)
+            self.expiry.clear()
+            for slot in self.slots: slot.clear()
+        else:
+            expiry, slots = self.expiry, self.slots
+            for tick in range(self.cursor, second):
+                slot = slots[tick % self.horizon]
+                for key in slot:
+                    # A key re-armed since it was queued here has a later expiry and a newer slot.
+                    if expiry.get(key, now + 1) <= now:
+                        del expiry[key]
+                        self.reclaimed += 1
+                slot.clear()
+        self.cursor = second
+
+    def try_acquire(self, guild_id, user_id, cooldown, now=None):
+        """True (and re-arm) if the member is off cooldown, False otherwise."""
+        if now is None: now = time.monotonic()
+        if int(now) > self.cursor: self._sweep(now)
+        key = (guild_id << 64) | user_id
+        until = self.expiry.get(key)
+        if until is not None and now < until: return False
+        until = self.expiry[key] = now + min(cooldown, self.horizon - 2)
+        self.slots[int(until) % self.horizon].append(key)
+        return True
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def nbytes(self):
+        # dict table + one 128-bit int key and one float per entry + the wheel's slot lists
+        return sys.getsizeof(self.expiry) + len(self.expiry) * (36 + 24) + sum(sys.getsizeof(slot) for slot in self.slots)
+
+    def summary(self):
+        return f"{len(self.expiry)} tracked · ~{self.nbytes() / 1024:.0f} KB · {self.reclaimed} reclaimed"
+
+xp_cooldowns = CooldownWheel()
+
+# === GUILD CONFIG ===
+PERMISSION_CACHE_SIZE = 50000
+
+class GuildConfig:
+    """Typed snapshot of one guild's config rows.
+
+    Built on first use and dropped by `set_config`, so hot paths read plain
+    attributes instead of going through the store. `version` is unique per
+    build, which lets permission decisions cached against an older snapshot
+    miss on their own.
+    """
+    __slots__ = ("prefixes", "admin_role", "mod_role", "muted_role", "welcome_channel", "goodbye_channel", "autorole",
+                 "xp_cooldown", "level_curve", "message_index", "automod", "keyword_rules", "raid_lockdown", "admin_ids", "staff_ids", "version")
+    builds = 0
+
+    def __init__(self, rows):
+        self.prefixes = rows.get("prefixes") or [rows.get("prefix", DEFAULT_PREFIX)]
+        self.admin_role, self.mod_role, self.muted_role = rows.get("admin_role"), rows.get("mod_role"), rows.get("muted_role")
+        self.welcome_channel, self.goodbye_channel, self.autorole = rows.get("welcome_channel"), rows.get("goodbye_channel"), rows.get("autorole")
+        self.xp_cooldown = rows.get("xp_cooldown", 60)
+        self.level_curve = tuple(rows.get("level_curve") or (100, 100))
+        self.message_index = rows.get("message_index", False)
+        self.automod = rows.get("automod", False)
+        self.keyword_rules = rows.get("keyword_rules", False)
+        self.raid_lockdown = rows.get("raid_lockdown", False)
+        self.admin_ids = frozenset(filter(None, (self.admin_role,)))
+        self.staff_ids = frozenset(filter(None, (self.admin_role, self.mod_role)))
+        GuildConfig.builds += 1
+        self.version = GuildConfig.builds
+
+guild_configs = {}           # int guild_id -> GuildConfig
+permission_decisions = {}    # (int guild_id, member_id) -> (config version, level)
+
+def guild_config(guild_id):
+    # Callers pass snowflakes as ints or (from the stores) strs; one key per guild keeps invalidation exact.
+    guild_id = int(guild_id)
+    if (config := guild_configs.get(guild_id)) is None: config = guild_configs[guild_id] = GuildConfig(get_guild_data(config_db, guild_id))
+    return config
+
+def invalidate_config(guild_id):
+    guild_id = int(guild_id)
+    guild_configs.pop(guild_id, None)
+    prefix_tables.pop(guild_id, None)
+
+def set_config(guild_id, **values):
+    """Write config rows and drop everything derived from them."""
+    rows = get_guild_data(config_db, guild_id)
+    for key, value in values.items():
+        rows[key] = value
+        mark_dirty(config_db, guild_id, key)
+    invalidate_config(guild_id)
 
 # === PERMISSION CHECKS ===
+STAFF_NONE, STAFF_MOD, STAFF_ADMIN = 0, 1, 2
+
+def staff_level(guild, member):
+    """Owner/admin, moderator or neither. Cached per member until the guild config or their roles change."""
+    config = guild_config(guild.id)
+    key = (int(guild.id), member.id)
+    cached = permission_decisions.get(key)
+    if cached and cached[0] == config.version: return cached[1]
+    # Member.get_role checks the member's sorted role-ID list, so this never builds Role objects.
+    if member.id == guild.owner_id or any(member.get_role(role_id) for role_id in config.admin_ids): level = STAFF_ADMIN
+    elif any(member.get_role(role_id) for role_id in config.staff_ids): level = STAFF_MOD
+    else: level = STAFF_NONE
+    if len(permission_decisions) >= PERMISSION_CACHE_SIZE: permission_decisions.clear()
+    permission_decisions[key] = (config.version, level)
+    return level
+
 def is_moderator():
     async def predicate(ctx):
-        if ctx.author == ctx.guild.owner: return True
-        guild_config = get_guild_data(config_db, ctx.guild.id)
-        admin_role_id = guild_config.get("admin_role")
-        mod_role_id = guild_config.get("mod_role")
-        if not mod_role_id and not admin_role_id:
-            raise commands.CheckFailure(f"Neither Moderator nor Admin roles are set. An admin must use `{get_prefix(bot, ctx.message)}setmodrole`.")
-        
-        mod_role = ctx.guild.get_role(mod_role_id) if mod_role_id else None
-        admin_role = ctx.guild.get_role(admin_role_id) if admin_role_id else None
-        
-        if (mod_role and mod_role in ctx.author.roles) or (admin_role and admin_role in ctx.author.roles):
-            return True
+        if staff_level(ctx.guild, ctx.author) >= STAFF_MOD: return True
+        config = guild_config(ctx.guild.id)
+        if not config.staff_ids:
+            raise commands.CheckFailure(f"Neither Moderator nor Admin roles are set. An admin must use `{display_prefix(ctx.message)}setmodrole`.")
         raise commands.CheckFailure("You need the server's configured Moderator or Admin role to use this command.")
     return commands.check(predicate)
 
 def is_admin():
     async def predicate(ctx):
-        if ctx.author == ctx.guild.owner: return True
-        guild_config = get_guild_data(config_db, ctx.guild.id)
-        admin_role_id = guild_config.get("admin_role")
-        if not admin_role_id:
-            raise commands.CheckFailure(f"The Admin role is not set. The server owner must use `{get_prefix(bot, ctx.message)}setadminrole`.")
-        
-        admin_role = ctx.guild.get_role(admin_role_id)
-        if admin_role and admin_role in ctx.author.roles:
-            return True
+        if staff_level(ctx.guild, ctx.author) == STAFF_ADMIN: return True
+        if not guild_config(ctx.guild.id).admin_ids:
+            raise commands.CheckFailure(f"The Admin role is not set. The server owner must use `{display_prefix(ctx.message)}setadminrole`.")
         raise commands.CheckFailure("You need the server's configured Admin role to use this command.")
     return commands.check(predicate)
 
+# === MEMBER NAME RESOLUTION ===
+NAME_CACHE_TTL = float(os.getenv("NAME_CACHE_TTL", "600"))   # seconds a resolved (or departed) name is trusted
+NAME_CACHE_MAX = 50_000
+LEFT, UNKNOWN = object(), object()   # negative cache marker / lookup failed for a transient reason
+
+class MemberNameResolver:
+    """Display names for leaderboard rows without one REST call per row.
+
+    The gateway member cache answers first. Misses are batched into a single
+    gateway member query (falling back to a few concurrent REST fetches), and
+    results, including "this user left", are kept for `ttl` seconds. Transient
+    failures such as rate limits are not cached and render as unknown rather
+    than as departed.
+    """
+    def __init__(self, ttl=NAME_CACHE_TTL, concurrency=4):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.cache = {}   # (guild_id, user_id) -> (expires_at, name or LEFT)
+        self.member_hits = self.cache_hits = self.queries = self.fetches = 0
+
+    def _remember(self, guild_id, user_id, name, now):
+        if len(self.cache) >= NAME_CACHE_MAX:
+            self.cache = {key: entry for key, entry in self.cache.items() if entry[0] > now}
+            if len(self.cache) >= NAME_CACHE_MAX: self.cache.clear()
+        self.cache[(guild_id, user_id)] = (now + self.ttl, name)
+
+    async def _fetch(self, guild, user_ids):
+        found, failed = {}, set()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def fetch(uid):
+            async with semaphore:
+                self.fetches += 1
+                try: found[uid] = (await guild.fetch_member(uid)).display_name
+                except discord.NotFound: pass
+                except discord.HTTPException: failed.add(uid)
+        await asyncio.gather(*(fetch(uid) for uid in user_ids))
+        return found, failed
+
+    async def _lookup(self, guild, user_ids):
+        try:
+            found = {}
+            for i in range(0, len(user_ids), 100):
+                self.queries += 1
+                for member in await guild.query_members(user_ids=user_ids[i:i + 100], limit=100, cache=True): found[member.id] = member.display_name
+            return found, set()
+        except (asyncio.TimeoutError, discord.ClientException): return await self._fetch(guild, user_ids)
+
+    async def resolve(self, guild, user_ids):
+        """Map each user ID to a display name, LEFT or UNKNOWN."""
+        now, names, missing = time.monotonic(), {}, []
+        for uid in user_ids:
+            if member := guild.get_member(uid):
+                names[uid] = member.display_name
+                self.member_hits += 1
+            elif (entry := self.cache.get((guild.id, uid))) and entry[0] > now:
+                names[uid] = entry[1]
+                self.cache_hits += 1
+            else: missing.append(uid)
+        if missing:
+            found, failed = await self._lookup(guild, missing)
+            for uid in missing:
+                if uid in failed: names[uid] = UNKNOWN; continue
+                names[uid] = found.get(uid, LEFT)
+                self._remember(guild.id, uid, names[uid], now)
+        return names
+
+    def summary(self):
+        return f"{len(self.cache)} cached names · {self.member_hits} member-cache hits · {self.cache_hits} TTL hits · {self.queries} gateway queries · {self.fetches} REST fetches"
+
+member_names = MemberNameResolver()
+
+def leaderboard_name(uid, name):
+    if name is LEFT: return f"User Left (ID: {uid})"
+    if name is UNKNOWN: return f"Unknown User (ID: {uid})"
+    return name
+
+# === MESSAGE INDEX ===
+MESSAGE_INDEX_MB = float(os.getenv("MESSAGE_INDEX_MB", "64"))      # budget shared by every channel buffer
+CHANNEL_BUFFER_SIZE = int(os.getenv("CHANNEL_BUFFER_SIZE", "1000"))   # messages kept per channel
+MESSAGE_WINDOW = int(os.getenv("MESSAGE_WINDOW", "200"))            # default window for count/search
+WORD_RE = re.compile(r"\w+")
+
+class ChannelBuffer:
+    """The last CHANNEL_BUFFER_SIZE messages of one channel as token tuples, plus token -> message positions.
+
+    Messages get increasing sequence numbers, so every posting list is sorted
+    and evicting the oldest message only ever pops from the left.
+    """
+    __slots__ = ("guild_id", "messages", "base", "postings", "nbytes")
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.messages = deque()   # (message id, author id, tokens), oldest first
+        self.base = 0             # sequence number of messages[0]
+        self.postings = {}        # token -> deque of sequence numbers
+        self.nbytes = 0
+
+    @staticmethod
+    def cost(tokens):
+        return 120 + 40 * len(tokens)
+
+    def append(self, message_id, author_id, tokens):
+        seq = self.base + len(self.messages)
+        self.messages.append((message_id, author_id, tokens))
+        for token in set(tokens):
+            if (posting := self.postings.get(token)) is None: posting = self.postings[token] = deque()
+            posting.append(seq)
+        self.nbytes += self.cost(tokens)
+        return self.trim(CHANNEL_BUFFER_SIZE)
+
+    def trim(self, size):
+        freed = 0
+        while len(self.messages) > size:
+            _, _, tokens = self.messages.popleft()
+            for token in set(tokens):
+                posting = self.postings[token]
+                posting.popleft()
+                if not posting: del self.postings[token]
+            self.base += 1
+            freed += self.cost(tokens)
+        self.nbytes -= freed
+        return freed
+
+    def matches(self, phrase, window):
+        """Sequence numbers (newest first) of messages in the last `window` containing the token phrase."""
+        first = self.base + max(0, len(self.messages) - window)
+        postings = [self.postings.get(token) for token in phrase]
+        if not postings or not all(postings): return []
+        rarest = min(postings, key=len)
+        found = []
+        for seq in reversed(rarest):
+            if seq < first: break
+            if len(phrase) == 1 or contains_phrase(self.messages[seq - self.base][2], phrase): found.append(seq)
+        return found
+
+def contains_phrase(tokens, phrase):
+    n = len(phrase)
+    return any(tokens[i:i + n] == phrase for i in range(len(tokens) - n + 1) if tokens[i] == phrase[0])
+
+class MessageIndex:
+    """Per-channel ring buffers for guilds that opted in, evicted coldest-channel-first past a byte budget.
+
+    Filled from on_message, so `count` and `search` answer from memory instead
+    of paging channel history over REST. Matching is on whole words.
+    """
+    def __init__(self, budget_mb=MESSAGE_INDEX_MB):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.channels = OrderedDict()   # channel_id -> ChannelBuffer, least recently written first
+        self.total = 0
+        self.evicted = 0
+
+    def add(self, message):
+        buffer = self.channels.get(message.channel.id)
+        if buffer is None: buffer = self.channels[message.channel.id] = ChannelBuffer(message.guild.id)
+        else: self.channels.move_to_end(message.channel.id)
+        tokens = tuple(sys.intern(word) for word in WORD_RE.findall(message.content.lower()))
+        self.total += ChannelBuffer.cost(tokens) - buffer.append(message.id, message.author.id, tokens)
+        while self.total > self.budget and len(self.channels) > 1:
+            _, cold = self.channels.popitem(last=False)
+            self.total -= cold.nbytes
+            self.evicted += 1
+
+    def buffer(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def drop_guild(self, guild_id):
+        for channel_id in [cid for cid, buffer in self.channels.items() if buffer.guild_id == guild_id]:
+            self.total -= self.channels.pop(channel_id).nbytes
+
+    def summary(self):
+        messages = sum(len(buffer.messages) for buffer in self.channels.values())
+        return f"{messages} messages in {len(self.channels)} channels · ~{self.total / 1048576:.1f}/{self.budget / 1048576:.0f} MB · {self.evicted} channels evicted"
+
+message_index = MessageIndex()
+
+# === AUTOMOD ===
+AUTOMOD_WINDOW = 5.0      # seconds covered by the rate counters
+USER_BURST = 6            # messages a member may send per window (half that while their channel is flooded)
+CHANNEL_FLOOD = 25        # messages per window that mark a channel as flooded
+DUP_HISTORY = 4           # recent message hashes remembered per member
+DUP_LIMIT = 3             # identical messages among those that count as spam
+DUP_WINDOW = 30.0         # ...if they all arrived within this many seconds
+MENTION_LIMIT = 5         # user + role mentions allowed in one message
+STRIKE_MEMORY = 600.0     # a second offence within this many seconds earns a timeout instead of a warning
+AUTOMOD_TIMEOUT = timedelta(minutes=10)
+AUTOMOD_IDLE = 60.0       # members idle this long are forgotten (after one more generation)
+
+class RateRing:
+    """Timestamps of the last `size` events; the sliding-window test is one index and one compare."""
+    __slots__ = ("times", "pos")
+
+    def __init__(self, size):
+        self.times, self.pos = [float("-inf")] * size, 0
+
+    def hit(self, now, window, limit=None):
+        """Record an event; True if `limit` (default: the ring size) events were already inside the window."""
+        times, pos = self.times, self.pos
+        size = len(times)
+        crowded = times[(pos - (limit or size)) % size] > now - window
+        times[pos], self.pos = now, (pos + 1) % size
+        return crowded
+
+class MemberActivity:
+    __slots__ = ("ring", "hashes", "hpos", "last", "struck_at", "quiet_until")
+
+    def __init__(self):
+        self.ring = RateRing(USER_BURST)
+        self.hashes, self.hpos = [0] * DUP_HISTORY, 0
+        self.last = self.struck_at = self.quiet_until = float("-inf")
+
+class Automod:
+    """Per-message spam checks for guilds that enable automod.
+
+    Each member gets a fixed-size record: a ring of their last USER_BURST
+    message times and the hashes of their last DUP_HISTORY messages. Channels
+    get a ring of CHANNEL_FLOOD times. Records live in two generations that
+    rotate every AUTOMOD_IDLE seconds, so idle members are dropped in O(1)
+    without a sweep. Offenders lose the message, get a warning, and get a
+    timeout if they offend again within STRIKE_MEMORY.
+    """
+    def __init__(self):
+        self.members, self.previous = {}, {}
+        self.channels = {}
+        self.rotate_at = time.monotonic() + AUTOMOD_IDLE
+        self.flagged = {"rate": 0, "duplicate": 0, "mentions": 0}
+        self.warned = self.timed_out = self.failed = 0
+        self._actions = set()
+
+    def _rotate(self, now):
+        self.previous, self.members = self.members, {}
+        self.channels = {cid: ring for cid, ring in self.channels.items() if ring.times[ring.pos - 1] > now - AUTOMOD_IDLE}
+        self.rotate_at = now + AUTOMOD_IDLE
+
+    def check(self, guild_id, channel_id, user_id, content, mentions, now=None):
+        """Reason the message is spam ("rate", "duplicate", "mentions") or None."""
+        if now is None: now = time.monotonic()
+        if now >= self.rotate_at: self._rotate(now)
+        key = (guild_id << 64) | user_id
+        member = self.members.get(key)
+        if member is None:
+            member = self.members[key] = self.previous.pop(key, None) or MemberActivity()
+        channel = self.channels.get(channel_id)
+        if channel is None: channel = self.channels[channel_id] = RateRing(CHANNEL_FLOOD)
+        flooded = channel.hit(now, AUTOMOD_WINDOW)
+        reason = None
+        if member.ring.hit(now, AUTOMOD_WINDOW, USER_BURST // 2 if flooded else USER_BURST): reason = "rate"
+        elif mentions > MENTION_LIMIT: reason = "mentions"
+        elif content:
+            digest = hash(" ".join(content.lower().split()))
+            if now - member.last <= DUP_WINDOW and member.hashes.count(digest) >= DUP_LIMIT - 1: reason = "duplicate"
+            member.hashes[member.hpos], member.hpos = digest, (member.hpos + 1) % DUP_HISTORY
+        member.last = now
+        if reason: self.flagged[reason] += 1
+        return reason
+
+    def act(self, message, reason):
+        task = asyncio.create_task(self._punish(message, reason))
+        self._actions.add(task)
+        task.add_done_callback(self._actions.discard)
+
+    async def _punish(self, message, reason):
+        now = time.monotonic()
+        member = self.members.get((message.guild.id << 64) | message.author.id)
+        try: await message.delete()
+        except discord.HTTPException: pass
+        # One warning or timeout per burst; the rest of the burst is only deleted.
+        if member is None or now < member.quiet_until: return
+        member.quiet_until = now + AUTOMOD_WINDOW
+        repeat, member.struck_at = now - member.struck_at <= STRIKE_MEMORY, now
+        text = {"rate": "sending messages too fast", "duplicate": "repeating the same message", "mentions": "mass mentions"}[reason]
+        try:
+            if repeat:
+                await message.author.timeout(AUTOMOD_TIMEOUT, reason=f"Automod: {text}")
+                self.timed_out += 1
+                outbound.send(message.channel, PRIO_MODERATION, f"⏳ **Automod:** {message.author.mention} timed out for {text}.")
+            else:
+                count = record_warning(message.guild, message.author, f"Automod: {text}", bot.user.name)
+                self.warned += 1
+                outbound.send(message.channel, PRIO_MODERATION, f"⚠️ **Automod:** {message.author.mention}, stop {text}. (warning #{count})")
+        except discord.HTTPException: self.failed += 1
+
+    def summary(self):
+        flagged = " · ".join(f"{count} {reason}" for reason, count in self.flagged.items())
+        return f"{len(self.members) + len(self.previous)} members tracked · flagged {flagged}\n{self.warned} warned · {self.timed_out} timed out · {self.failed} failed"
+
+automod = Automod()
+
+# === KEYWORD RULES ===
+MAX_KEYWORD_RULES = 10000   # banned words + auto-responses per guild
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: finds every pattern in a text in one pass, whatever the pattern count.
+
+    Edges live in one flat dict keyed by `state << 21 | ord(char)` rather than
+    a dict per node. Adding a pattern only extends the trie and removing one
+    only clears its output; failure links and merged outputs are recomputed
+    lazily on the next search, and the trie is rebuilt from scratch once dead
+    nodes outnumber live patterns.
+    """
+    __slots__ = ("edges", "children", "fail", "own", "out", "patterns", "dirty", "dead")
+
+    def __init__(self, patterns=()):
+        self.edges = {}
+        self.children, self.fail, self.own, self.out = [[]], [0], [None], [()]
+        self.patterns = set()
+        self.dirty, self.dead = False, 0
+        for pattern in patterns: self.add(pattern)
+
+    def add(self, pattern):
+        if not pattern or pattern in self.patterns: return
+        state = 0
+        for ch in pattern:
+            key = (state << 21) | ord(ch)
+            nxt = self.edges.get(key)
+            if nxt is None:
+                nxt = self.edges[key] = len(self.fail)
+                self.children[state].append(ord(ch))
+                self.children.append([]); self.fail.append(0); self.own.append(None); self.out.append(())
+            state = nxt
+        self.own[state] = pattern
+        self.patterns.add(pattern)
+        self.dirty = True
+
+    def remove(self, pattern):
+        if pattern not in self.patterns: return
+        self.patterns.discard(pattern)
+        state = 0
+        for ch in pattern: state = self.edges[(state << 21) | ord(ch)]
+        self.own[state] = None
+        self.dead += len(pattern)
+        self.dirty = True
+        if self.dead > 4 * max(len(self.patterns), 16): self.__init__(self.patterns)
+
+    def _link(self):
+        # Breadth-first, so a node's failure target is always finished before the node itself.
+        edges, children, fail, own, out = self.edges, self.children, self.fail, self.own, self.out
+        queue = deque()
+        for code in children[0]:
+            child = edges[code]
+            fail[child] = 0
+            queue.append(child)
+        out[0] = ()
+        while queue:
+            state = queue.popleft()
+            out[state] = ((own[state],) if own[state] else ()) + out[fail[state]]
+            for code in children[state]:
+                child, f = edges[(state << 21) | code], fail[state]
+                while f and (f << 21) | code not in edges: f = fail[f]
+                fail[child] = edges.get((f << 21) | code, 0)
+                queue.append(child)
+        self.dirty = False
+
+    def find(self, text):
+        """Yield (start, end, pattern) for every occurrence, in order of end position."""
+        if self.dirty: self._link()
+        edges, fail, out = self.edges, self.fail, self.out
+        state = 0
+        for i, ch in enumerate(text):
+            code = ord(ch)
+            while True:
+                nxt = edges.get((state << 21) | code)
+                if nxt is not None:
+                    state = nxt
+                    break
+                if not state: break
+                state = fail[state]
+            if out[state]:
+                for pattern in out[state]: yield i - len(pattern) + 1, i + 1, pattern
+
+class GuildRules:
+    """One guild's banned words and trigger -> response rules, compiled into a single automaton."""
+    __slots__ = ("banned", "responses", "automaton")
+
+    def __init__(self, banned, responses):
+        self.banned, self.responses = set(banned), dict(responses)
+        self.automaton = KeywordAutomaton(self.banned | set(self.responses))
+
+    def __len__(self):
+        return len(self.banned) + len(self.responses)
+
+    def _retire(self, pattern):
+        if pattern not in self.banned and pattern not in self.responses: self.automaton.remove(pattern)
+
+    def ban(self, word):
+        self.banned.add(word)
+        self.automaton.add(word)
+
+    def unban(self, word):
+        self.banned.discard(word)
+        self._retire(word)
+
+    def set_response(self, trigger, response):
+        self.responses[trigger] = response
+        self.automaton.add(trigger)
+
+    def drop_response(self, trigger):
+        self.responses.pop(trigger, None)
+        self._retire(trigger)
+
+    def scan(self, content):
+        """(first banned word, first auto-response) among whole-word matches in content."""
+        text, response = content.lower(), None
+        for start, end, pattern in self.automaton.find(text):
+            if (start and text[start - 1].isalnum()) or (end < len(text) and text[end].isalnum()): continue
+            if pattern in self.banned: return pattern, None
+            if response is None: response = self.responses.get(pattern)
+        return None, response
+
+guild_rules = {}   # guild_id -> GuildRules, edited in place by the rule commands
+
+def rules_for(guild_id):
+    if (rules := guild_rules.get(guild_id)) is None:
+        rows = get_guild_data(config_db, guild_id)
+        rules = guild_rules[guild_id] = GuildRules(rows.get("banned_words", ()), rows.get("auto_responses", {}))
+    return rules
+
+def save_rules(guild_id, rules):
+    set_config(guild_id, banned_words=sorted(rules.banned), auto_responses=rules.responses, keyword_rules=len(rules) > 0)
+
+# === OUTBOUND MESSAGES ===
+PRIO_MODERATION, PRIO_FUN, PRIO_ANNOUNCE = 0, 1, 2
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "2.0"))   # seconds a level-up/welcome waits for company
+LANE_LIMIT = 50                  # pending messages per channel before the least important are dropped
+MERGE_LIMIT = 20                 # payloads folded into one embed
+CHANNEL_BURST, CHANNEL_PERIOD = 5, 5.0   # Discord allows about 5 messages per 5s in one channel
+
+class LaneDropped(commands.CommandError):
+    """A queued message was dropped (lane full or closed) before it could be sent."""
+
+class Outgoing:
+    __slots__ = ("priority", "seq", "not_before", "key", "payloads", "render", "extra", "future")
+
+    def __init__(self, priority, seq, not_before, key, payloads, render, extra=None, future=None):
+        self.priority, self.seq, self.not_before, self.key, self.payloads, self.render = priority, seq, not_before, key, payloads, render
+        self.extra = extra or {}   # other send() kwargs (file, delete_after, reference, ...)
+        self.future = future       # resolved with the sent Message (or the error) for callers that wait
+
+    def settle(self, message=None, error=None):
+        if self.future is None or self.future.done(): return
+        if error is None: self.future.set_result(message)
+        else: self.future.set_exception(error)
+
+    def __lt__(self, other): return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Lane:
+    """Pending messages for one channel or DM, drained by a single task."""
+    __slots__ = ("dest", "heap", "open", "wake", "task", "sent_at")
+
+    def __init__(self, dest):
+        self.dest, self.heap, self.open = dest, [], {}
+        self.wake = asyncio.Event()
+        self.task = None
+        self.sent_at = deque(maxlen=CHANNEL_BURST)
+
+class OutboundQueue:
+    """Per-channel priority queues for messages the bot sends on its own.
+
+    Each channel gets a lane that sends one message at a time, most important
+    first (command and moderation replies, then fun replies, then
+    announcements), and paces itself to the channel rate limit instead of leaning on
+    429 retries. Announcements sharing a coalesce key (level-ups, welcomes)
+    wait COALESCE_WINDOW seconds and anything with the same key that arrives
+    meanwhile is folded into the same embed. A full lane drops its least
+    important message. Lanes disappear once drained.
+    """
+    def __init__(self):
+        self.lanes = {}
+        self._seq = 0
+        self.sent = self.merged = self.dropped = self.failed = 0
+
+    def _lane(self, dest):
+        if (lane := self.lanes.get(dest.id)) is None: lane = self.lanes[dest.id] = Lane(dest)
+        return lane
+
+    def send(self, dest, priority, content=None, embed=None, **extra):
+        self._push(self._lane(dest), Outgoing(priority, 0, 0.0, None, [(content, embed)], lambda payloads: payloads[0], extra))
+
+    async def request(self, dest, priority, content=None, embed=None, **extra):
+        """Like send, but waits for the message to go out and returns it (or raises what sending raised)."""
+        future = asyncio.get_running_loop().create_future()
+        self._push(self._lane(dest), Outgoing(priority, 0, 0.0, None, [(content, embed)], lambda payloads: payloads[0], extra, future))
+        return await future
+
+    def coalesce(self, dest, priority, key, payload, render):
+        """Queue payload under key; render(payloads) -> (content, embed) builds the merged message."""
+        lane = self._lane(dest)
+        if (item := lane.open.get(key)) and len(item.payloads) < MERGE_LIMIT:
+            item.payloads.append(payload)
+            self.merged += 1
+            return
+        item = lane.open[key] = Outgoing(priority, 0, time.monotonic() + COALESCE_WINDOW, key, [payload], render)
+        self._push(lane, item)
+
+    def _discard(self, lane, item, error=None):
+        if item.key is not None and lane.open.get(item.key) is item: del lane.open[item.key]
+        self.dropped += len(item.payloads)
+        # Whoever awaits the send gets an error, never a None where they expected a Message.
+        item.settle(error=error or LaneDropped(f"Message to channel {lane.dest.id} was dropped"))
+
+    def _push(self, lane, item):
+        self._seq += 1
+        item.seq = self._seq
+        if len(lane.heap) >= LANE_LIMIT:
+            worst = max(lane.heap)
+            if not item < worst: return self._discard(lane, item)
+            lane.heap.remove(worst)
+            heapq.heapify(lane.heap)
+            self._discard(lane, worst)
+        heapq.heappush(lane.heap, item)
+        lane.wake.set()
+        if lane.task is None: lane.task = asyncio.create_task(self._drain(lane))
+
+    async def _drain(self, lane):
+        forbidden = None
+        try:
+            while lane.heap:
+                item, now = lane.heap[0], time.monotonic()
+                wait = item.not_before - now
+                if len(lane.sent_at) == CHANNEL_BURST: wait = max(wait, lane.sent_at[0] + CHANNEL_PERIOD - now)
+                if wait > 0:
+                    # Something more urgent may arrive while we wait.
+                    lane.wake.clear()
+                    await wait_event(lane.wake, wait)
+                    continue
+                heapq.heappop(lane.heap)
+                if item.key is not None and lane.open.get(item.key) is item: del lane.open[item.key]
+                lane.sent_at.append(time.monotonic())
+                try:
+                    content, embed = item.render(item.payloads)
+                    item.settle(await lane.dest.send(content=content, embed=embed, **item.extra))
+                    self.sent += 1
+                except discord.HTTPException as e:
+                    self.failed += 1
+                    print(f"Could not send to channel {lane.dest.id}: {e}")
+                    item.settle(error=e)
+                    if e.status == 429: await asyncio.sleep(getattr(e, "retry_after", CHANNEL_PERIOD))
+                    elif isinstance(e, discord.Forbidden):
+                        forbidden = e
+                        break
+                except Exception as e:
+                    self.failed += 1
+                    print(f"Error sending to channel {lane.dest.id}:\n{traceback.format_exc()}")
+                    item.settle(error=e)
+        finally:
+            for item in lane.heap: self._discard(lane, item, forbidden)
+            if self.lanes.get(lane.dest.id) is lane: del self.lanes[lane.dest.id]
+
+    def summary(self):
+        pending = sum(len(lane.heap) for lane in self.lanes.values())
+        return f"{pending} pending in {len(self.lanes)} channels · {self.sent} sent · {self.merged} merged · {self.dropped} dropped · {self.failed} failed"
+
+outbound = OutboundQueue()
+
+class LaneContext(commands.Context):
+    """Command context whose replies go through the channel's outbound lane at moderation priority.
+
+    send() still returns the Message and raises what sending raised, so
+    commands keep using `await ctx.send(...)` as before.
+    """
+    async def send(self, content=None, *, embed=None, ephemeral=False, **kwargs):
+        return await outbound.request(self.channel, PRIO_MODERATION, content, embed, **kwargs)
+
+def render_level_ups(payloads):
+    if len(payloads) == 1:
+        member, level = payloads[0]
+        embed = discord.Embed(title="🎉 LEVEL UP!", description=f"Congrats {member.mention}!", color=discord.Color.gold())
+        embed.add_field(name="New Level", value=f"**{level}**")
+        embed.set_thumbnail(url=member.display_avatar.url)
+        return None, embed
+    latest = {member.id: (member, level) for member, level in payloads}
+    lines = [f"Congrats {member.mention}! Now level **{level}**" for member, level in latest.values()]
+    return None, discord.Embed(title="🎉 LEVEL UP!", description="\n".join(lines), color=discord.Color.gold())
+
+def render_welcomes(payloads):
+    member = payloads[0]
+    if len(payloads) == 1:
+        embed = discord.Embed(title=f"Welcome to {member.guild.name}!", description=f"Hello {member.mention}, we're glad to have you! 🎉", color=discord.Color.green())
+        embed.set_thumbnail(url=member.display_avatar.url)
+        return None, embed
+    return None, discord.Embed(title=f"Welcome to {member.guild.name}!", description=f"Hello {', '.join(m.mention for m in payloads)}, we're glad to have you! 🎉", color=discord.Color.green())
+
+def render_goodbyes(payloads):
+    names = ", ".join(f"**{m.display_name}**" for m in payloads)
+    return None, discord.Embed(description=f"{names} {'has' if len(payloads) == 1 else 'have'} left the server. Goodbye! 👋", color=discord.Color.red())
+
+def fun_reply(ctx, content=None, embed=None):
+    outbound.send(ctx.channel, PRIO_FUN, content, embed)
+
+# === REMINDERS ===
+REMINDER_MAX_DAYS = 365
+REMINDER_BATCH = 25   # deliveries in flight at once when many reminders come due together
+REMINDER_RETRIES = 5  # failed deliveries retried with backoff (1, 2, 4, 8, 16 minutes) before giving up
+
+class ReminderScheduler:
+    """Every pending reminder in one min-heap, served by a single timer task.
+
+    Reminders live as rows in `reminders_db`, so the write-behind engine makes
+    them durable and `start()` rebuilds the heap from storage on boot. The heap
+    only holds `(due, id, guild_id)`; the text is read back when it fires. The
+    timer sleeps until the earliest due time (or until an earlier reminder is
+    added), then delivers everything that is due in bounded batches. A row is
+    only deleted once its delivery went through; a failed one is pushed back
+    with exponential backoff.
+    """
+    def __init__(self):
+        self.heap = []
+        self.next_id = 1
+        self.delivered = self.late = self.failed = 0
+        self._wake = None
+        self._task = None
+
+    def add(self, guild_id, user_id, channel_id, due, text):
+        rid = self.next_id
+        self.next_id += 1
+        get_guild_data(reminders_db, guild_id)[str(rid)] = {"user": user_id, "channel": channel_id, "due": due, "text": text}
+        mark_dirty(reminders_db, guild_id, rid)
+        heapq.heappush(self.heap, (due, rid, str(guild_id)))
+        if self._wake and self.heap[0][1] == rid: self._wake.set()
+        return rid
+
+    def load(self):
+        for guild_id, rows in storage.load_all(reminders_db.name).items():
+            for key, row in rows.items():
+                if key.isdigit() and isinstance(row, dict) and "due" in row: self.heap.append((row["due"], int(key), guild_id))
+        heapq.heapify(self.heap)
+        self.next_id = max((rid for _, rid, _ in self.heap), default=0) + 1
+
+    def take_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, rid, guild_id = heapq.heappop(self.heap)
+            if (row := get_guild_data(reminders_db, guild_id).get(str(rid))) is not None: due.append((guild_id, rid, row))
+        return due
+
+    async def deliver(self, guild_id, row, now):
+        """True once the reminder reached the user (or their channel)."""
+        guild = bot.get_guild(int(guild_id))
+        late = now - row["due"] > 60
+        text = f"⏰ **Reminder from {guild.name if guild else 'a server'}:**{' (delivered late, I was offline)' if late else ''}\n> {row['text']}"
+        try:
+            user = bot.get_user(row["user"]) or await bot.fetch_user(row["user"])
+            await user.send(text)
+        except discord.HTTPException:
+            # DMs closed or user gone: fall back to the channel the reminder was set in.
+            if not (guild and (channel := guild.get_channel(row["channel"]))): return False
+            outbound.send(channel, PRIO_FUN, f"⏰ <@{row['user']}>, your reminder is up! `{row['text']}`")
+        self.late += late
+        return True
+
+    async def settle(self, guild_id, rid, row, now):
+        try: ok = await self.deliver(guild_id, row, now)
+        except Exception:
+            print(f"Error delivering reminder {rid} in {guild_id}:\n{traceback.format_exc()}")
+            ok = False
+        # Re-read by key: the guild may have been evicted and reloaded while we awaited, and ids are never reused.
+        rows = get_guild_data(reminders_db, guild_id)
+        if (row := rows.get(str(rid))) is None: return
+        if ok or row.get("attempts", 0) >= REMINDER_RETRIES:
+            if ok: self.delivered += 1
+            else:
+                print(f"Giving up on reminder {rid} in {guild_id} after {REMINDER_RETRIES} retries")
+                self.failed += 1
+            del rows[str(rid)]
+            mark_dirty(reminders_db, guild_id, rid)
+            return
+        row["attempts"] = row.get("attempts", 0) + 1
+        mark_dirty(reminders_db, guild_id, rid)
+        heapq.heappush(self.heap, (time.time() + 60 * 2 ** (row["attempts"] - 1), rid, guild_id))
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            try:
+                self._wake.clear()
+                now = time.time()
+                if due := self.take_due(now):
+                    for i in range(0, len(due), REMINDER_BATCH):
+                        await asyncio.gather(*(self.settle(guild_id, rid, row, now) for guild_id, rid, row in due[i:i + REMINDER_BATCH]))
+                    continue
+                await wait_event(self._wake, self.heap[0][0] - now if self.heap else None)
+            except Exception:
+                # This is the only timer; one bad pass must not stop every later reminder.
+                print(f"Error in the reminder scheduler:\n{traceback.format_exc()}")
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._task: return
+        self.load()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def summary(self):
+        upcoming = f"next in {max(0, self.heap[0][0] - time.time()):.0f}s" if self.heap else "none pending"
+        return f"{len(self.heap)} pending ({upcoming}) · {self.delivered} delivered · {self.late} late · {self.failed} failed"
+
+reminders = ReminderScheduler()
+
+# === TEMPORARY PUNISHMENTS ===
+EXPIRY_CONCURRENCY = 5   # role removals/unbans in flight per guild
+EXPIRY_RETRIES = 8       # failed lifts retried with backoff (1, 2, 4 ... 128 minutes) before giving up
+
+class ExpiryEngine:
+    """Durable expiry index for tempmute/tempban.
+
+    Each active punishment is a row in `temp_actions_db`; a min-heap of
+    `(until, guild_id, key)` drives one timer task. Due rows are grouped by
+    guild and lifted with bounded concurrency. Heap entries are never removed
+    in place: a lifted, cancelled or extended punishment leaves a stale entry
+    that is skipped when it surfaces. A row is only deleted once its
+    punishment is lifted; a failed lift (or a guild that is unavailable) is
+    retried with exponential backoff. On startup `reconcile()` walks every
+    guild with pending rows once, comparing them with the live Muted role and
+    ban list, and drops rows whose punishment was already lifted by hand.
+    """
+    def __init__(self):
+        self.heap = []
+        self.lifted = self.reconciled = self.failed = 0
+        self._wake = None
+        self._task = None
+
+    def schedule(self, guild_id, action, user_id, seconds, reason):
+        until, key = time.time() + seconds, f"{action}:{user_id}"
+        get_guild_data(temp_actions_db, guild_id)[key] = {"until": until, "reason": reason}
+        mark_dirty(temp_actions_db, guild_id, key)
+        heapq.heappush(self.heap, (until, str(guild_id), key))
+        if self._wake and self.heap[0][2] == key: self._wake.set()
+
+    def cancel(self, guild_id, action, user_id):
+        key = f"{action}:{user_id}"
+        if get_guild_data(temp_actions_db, guild_id).pop(key, None) is not None: mark_dirty(temp_actions_db, guild_id, key)
+
+    def load(self):
+        for guild_id, rows in storage.load_all(temp_actions_db.name).items():
+            self.heap.extend((row["until"], guild_id, key) for key, row in rows.items() if isinstance(row, dict) and "until" in row)
+        heapq.heapify(self.heap)
+
+    def take_due(self, now):
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            _, guild_id, key = heapq.heappop(self.heap)
+            rows = get_guild_data(temp_actions_db, guild_id)
+            if (row := rows.get(key)) is None or row["until"] > now: continue   # cancelled or extended
+            due.setdefault(guild_id, []).append((key, row["until"]))
+        return due
+
+    async def lift(self, guild, key):
+        """True once the punishment is gone (lifted now or already lifted by hand)."""
+        action, user_id = key.split(":")
+        try:
+            if action == "mute":
+                member, role = guild.get_member(int(user_id)), muted_role(guild)
+                if member and role and role in member.roles: await member.remove_roles(role, reason="Tempmute expired")
+            else: await guild.unban(discord.Object(id=int(user_id)), reason="Tempban expired")
+        except discord.NotFound: pass   # already lifted by hand
+        except discord.HTTPException as e:
+            print(f"Could not lift {key} in {guild.id}: {e}")
+            return False
+        except Exception:
+            print(f"Error lifting {key} in {guild.id}:\n{traceback.format_exc()}")
+            return False
+        return True
+
+    def settle(self, guild_id, key, until, ok):
+        # Re-read by key: the row may have been cancelled, replaced or extended (or its guild reloaded) meanwhile.
+        rows = get_guild_data(temp_actions_db, guild_id)
+        if (row := rows.get(key)) is None or row["until"] != until: return
+        if ok: self.lifted += 1
+        else: self.failed += 1
+        if ok or row.get("attempts", 0) >= EXPIRY_RETRIES:
+            if not ok: print(f"Giving up on lifting {key} in {guild_id} after {EXPIRY_RETRIES} retries")
+            del rows[key]
+            mark_dirty(temp_actions_db, guild_id, key)
+            return
+        row["attempts"] = row.get("attempts", 0) + 1
+        mark_dirty(temp_actions_db, guild_id, key)
+        heapq.heappush(self.heap, (time.time() + 60 * 2 ** (row["attempts"] - 1), guild_id, key))
+
+    async def expire_guild(self, guild_id, items):
+        guild = bot.get_guild(int(guild_id))
+        if guild is None or guild.unavailable:
+            # Left for good or in an outage: we can't tell yet, so retry rather than forget the punishment.
+            for key, until in items: self.settle(guild_id, key, until, False)
+            return
+        limit = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+        async def bounded(key, until):
+            async with limit: self.settle(guild_id, key, until, await self.lift(guild, key))
+        await asyncio.gather(*(bounded(key, until) for key, until in items))
+
+    async def reconcile(self):
+        for guild_id in {guild_id for _, guild_id, _ in self.heap}:
+            rows, guild = get_guild_data(temp_actions_db, guild_id), bot.get_guild(int(guild_id))
+            if guild is None: continue
+            role = muted_role(guild)
+            muted = {m.id for m in role.members} if role else set()
+            banned = set()
+            if any(key.startswith("ban:") for key in rows):
+                try: banned = {entry.user.id async for entry in guild.bans(limit=None)}
+                except discord.HTTPException: continue   # can't see bans, leave the rows for the timer
+            for key in list(rows):
+                action, user_id = key.split(":")
+                if int(user_id) not in (muted if action == "mute" else banned):
+                    del rows[key]
+                    mark_dirty(temp_actions_db, guild_id, key)
+                    self.reconciled += 1
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        try: await self.reconcile()
+        except Exception: print(f"Error reconciling temp punishments:\n{traceback.format_exc()}")
+        while True:
+            try:
+                self._wake.clear()
+                now = time.time()
+                if due := self.take_due(now):
+                    for guild_id, keys in due.items():
+                        try: await self.expire_guild(guild_id, keys)
+                        except Exception: print(f"Error expiring punishments in {guild_id}:\n{traceback.format_exc()}")
+                    continue
+                await wait_event(self._wake, self.heap[0][0] - now if self.heap else None)
+            except Exception:
+                # This is the only timer; one bad pass must not stop every later expiry.
+                print(f"Error in the expiry engine:\n{traceback.format_exc()}")
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._task: return
+        self.load()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def summary(self):
+        return f"{len(self.heap)} queued · {self.lifted} lifted · {self.reconciled} reconciled on boot · {self.failed} failed"
+
+expiries = ExpiryEngine()
+
+# === RAID PROTECTION ===
+RAID_JOINS = 10            # joins within RAID_WINDOW that switch a guild into raid mode
+RAID_WINDOW = 10.0
+RAID_QUIET = 120.0         # raid mode ends this long after the last burst, unless the guild is locked down
+RAID_ACCOUNT_AGE = timedelta(days=7)   # younger (or avatar-less) accounts joining mid-raid are flagged
+AUTOROLE_CONCURRENCY = 3   # autorole grants in flight while any guild is raided
+BULK_BAN_CHUNK = 200       # Discord's limit per bulk ban request
+
+class RaidState:
+    __slots__ = ("started", "last_burst", "joined", "flagged", "locked", "active", "watcher")
+
+    def __init__(self, now):
+        self.started = self.last_burst = now
+        self.joined = 0
+        self.flagged = {}    # user id -> name, for raidban
+        self.locked = []     # channels this raid's lockdown locked, reopened by endraid
+        self.active = True
+        self.watcher = None
+
+class JoinGuard:
+    """Sliding-window join counter per guild that flips it into raid mode during a join burst.
+
+    In raid mode welcomes are replaced by one summary when the raid ends,
+    autoroles go through a small worker pool instead of one request per join
+    as it happens, suspicious accounts are collected for `raidban`, and guilds
+    that opted in get every open text channel locked.
+    """
+    def __init__(self):
+        self.rings = {}    # guild_id -> RateRing of join times
+        self.raids = {}    # guild_id -> RaidState of the current or most recent raid
+        self.autoroles = None
+        self._workers = []
+        self.detected = self.roles_given = 0
+
+    def on_join(self, member, now=None):
+        """The guild's active RaidState (and whether this join started it), or (None, False)."""
+        if now is None: now = time.monotonic()
+        guild_id = member.guild.id
+        if (ring := self.rings.get(guild_id)) is None: ring = self.rings[guild_id] = RateRing(RAID_JOINS)
+        burst, started = ring.hit(now, RAID_WINDOW), False
+        raid = self.raids.get(guild_id)
+        if burst:
+            if raid is None or not raid.active:
+                raid, started = RaidState(now), True
+                self.raids[guild_id] = raid
+                self.detected += 1
+            raid.last_burst = now
+        if raid is None or not raid.active: return None, False
+        raid.joined += 1
+        if discord.utils.utcnow() - member.created_at < RAID_ACCOUNT_AGE or member.avatar is None: raid.flagged[member.id] = str(member)
+        return raid, started
+
+    def queue_autorole(self, member, role):
+        if self.autoroles is None:
+            self.autoroles = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._grant_roles()) for _ in range(AUTOROLE_CONCURRENCY)]
+        self.autoroles.put_nowait((member, role))
+
+    async def _grant_roles(self):
+        while True:
+            member, role = await self.autoroles.get()
+            try:
+                await member.add_roles(role, reason="Autorole on join")
+                self.roles_given += 1
+            except discord.HTTPException: pass
+
+    async def start_raid(self, guild, raid):
+        config = guild_config(guild.id)
+        channel = guild.get_channel(config.welcome_channel) if config.welcome_channel else None
+        if config.raid_lockdown:
+            open_channels = [c for c in guild.text_channels if c.overwrites_for(guild.default_role).send_messages is not False]
+            raid.locked = [c.id for c in open_channels]
+            await lock_channels(open_channels, guild, True)
+        if channel: outbound.send(channel, PRIO_MODERATION, f"🚨 **Raid detected!** Welcomes are paused{' and the server is locked down' if raid.locked else ''}. Moderators can use `raidlist`, `raidban` and `endraid`.")
+        raid.watcher = asyncio.create_task(self._watch(guild, raid))
+
+    async def _watch(self, guild, raid):
+        while raid.active:
+            await asyncio.sleep(RAID_QUIET / 4)
+            if not raid.locked and time.monotonic() - raid.last_burst >= RAID_QUIET: await self.end_raid(guild, raid)
+
+    async def end_raid(self, guild, raid):
+        if not raid.active: return
+        raid.active = False
+        if raid.locked:
+            await lock_channels([c for cid in raid.locked if (c := guild.get_channel(cid))], guild, False)
+            raid.locked = []
+        config = guild_config(guild.id)
+        if config.welcome_channel and (channel := guild.get_channel(config.welcome_channel)):
+            outbound.send(channel, PRIO_ANNOUNCE, f"🛡️ **Raid mode ended.** {raid.joined} members joined during the raid ({len(raid.flagged)} flagged). Welcome, everyone!")
+
+    async def ban_flagged(self, guild, raid, reason):
+        """Ban every flagged account in chunks; returns (banned, failed)."""
+        ids = list(raid.flagged)
+        banned = failed = 0
+        for i in range(0, len(ids), BULK_BAN_CHUNK):
+            chunk = [discord.Object(id=uid) for uid in ids[i:i + BULK_BAN_CHUNK]]
+            try:
+                result = await guild.bulk_ban(chunk, reason=reason)
+                banned, failed = banned + len(result.banned), failed + len(result.failed)
+            except discord.HTTPException: failed += len(chunk)
+        raid.flagged.clear()
+        return banned, failed
+
+    def summary(self):
+        active = sum(raid.active for raid in self.raids.values())
+        queued = self.autoroles.qsize() if self.autoroles else 0
+        return f"{self.detected} raids detected · {active} active · {queued} autoroles queued · {self.roles_given} given in raid mode"
+
+join_guard = JoinGuard()
+
+# === COMMAND METRICS ===
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)   # seconds, Prometheus-style upper bounds
+OUTCOMES = ("ok", "check", "usage", "cooldown", "error")
+
+class CommandStats:
+    """Fixed-bucket latency histogram plus outcome counters for one command."""
+    __slots__ = ("buckets", "count", "total", "outcomes")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)   # last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Estimate by interpolating inside the bucket that holds the q-th observation."""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, hits in enumerate(self.buckets):
+            if hits and seen + hits >= rank:
+                low = LATENCY_BUCKETS[i - 1] if i else 0.0
+                high = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+                return low + (high - low) * (rank - seen) / hits
+            seen += hits
+        return LATENCY_BUCKETS[-1]
+
+class CommandMetrics:
+    """Per-command latency and outcomes, fed by the before/after invoke hooks and on_command_error."""
+    def __init__(self):
+        self.commands = {}   # qualified command name -> CommandStats
+
+    def stats(self, name):
+        if (stats := self.commands.get(name)) is None: stats = self.commands[name] = CommandStats()
+        return stats
+
+    def record(self, name, outcome):
+        self.stats(name).outcomes[outcome] += 1
+
+    def slowest(self, n=5):
+        return sorted(((name, stats) for name, stats in self.commands.items() if stats.count), key=lambda item: item[1].quantile(0.95), reverse=True)[:n]
+
+    def summary(self):
+        lines = [f"`{name}` ×{stats.count} · p50 {stats.quantile(0.5) * 1000:.0f} / p95 {stats.quantile(0.95) * 1000:.0f} / p99 {stats.quantile(0.99) * 1000:.0f} ms"
+                 + (f" · {stats.outcomes['error']} errors" if stats.outcomes["error"] else "") for name, stats in self.slowest()]
+        failed = sum(stats.outcomes["check"] for stats in self.commands.values())
+        errors = sum(stats.outcomes["error"] for stats in self.commands.values())
+        return "\n".join(lines + [f"{failed} check failures · {errors} errors"]) if lines else "No commands run yet."
+
+    def families(self):
+        buckets, sums, counts, outcomes = [], [], [], []
+        for name, stats in self.commands.items():
+            cumulative = 0
+            for bound, hits in zip(LATENCY_BUCKETS + ("+Inf",), stats.buckets):
+                cumulative += hits
+                buckets.append(("_bucket", {"command": name, "le": bound}, cumulative))
+            sums.append(("_sum", {"command": name}, stats.total))
+            counts.append(("_count", {"command": name}, stats.count))
+            outcomes.extend(({"command": name, "outcome": outcome}, hits) for outcome, hits in stats.outcomes.items() if hits)
+        return [
+            ("command_latency_seconds", "histogram", "Command latency from before_invoke to after_invoke.", buckets + sums + counts),
+            ("command_outcomes_total", "counter", "Command invocations by outcome.", outcomes),
+        ]
+
+command_metrics = CommandMetrics()
+
+# === PROFILER ===
+PROFILE_HZ = 200         # stack samples per second while profiling
+PROFILE_MAX_SECONDS = 60
+
+class StackSampler:
+    """CPU sampler for the event-loop thread, active only for the window a `profile` command asks for.
+
+    Where the platform has SIGPROF, an interval timer interrupts the process
+    every 1/hz seconds of CPU time and the handler records the interrupted
+    stack, so idle time produces no samples and nothing is skewed toward the
+    points where the loop releases the GIL. Elsewhere a helper thread polls
+    sys._current_frames(). Samples that land in the selector (the loop waiting
+    while another thread burns CPU) are counted as idle and kept out of the
+    tables.
+    """
+    def __init__(self, hz=PROFILE_HZ):
+        self.interval = 1 / hz
+        self.stacks = {}      # tuple of frame labels, outermost first -> samples
+        self.samples = self.idle = 0
+        self.mode = "SIGPROF" if hasattr(signal, "setitimer") and current_thread() is main_thread() else "thread"
+
+    def record(self, frame):
+        self.samples += 1
+        if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+            self.idle += 1
+            return
+        stack = []
+        while frame is not None and len(stack) < 128:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        key = tuple(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def _poll(self, thread_id, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            if (frame := sys._current_frames().get(thread_id)) is not None: self.record(frame)
+            time.sleep(self.interval)
+
+    async def run(self, seconds):
+        if self.mode == "thread":
+            await asyncio.to_thread(self._poll, get_ident(), seconds)
+            return self
+        previous = signal.signal(signal.SIGPROF, lambda signum, frame: self.record(frame))
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try: await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+        return self
+
+    @staticmethod
+    def label(code):
+        return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def top(self, n=15):
+        """[(self samples, total samples, function)] by self time."""
+        own, total = {}, {}
+        for stack, hits in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + hits
+            for function in set(stack): total[function] = total.get(function, 0) + hits
+        return sorted(((hits, total[function], function) for function, hits in own.items()), reverse=True)[:n]
+
+    def collapsed(self):
+        # Brendan Gregg's folded format: `outer;...;inner count`, one line per distinct stack.
+        return "".join(f"{';'.join(frame.replace(';', ':') for frame in stack)} {hits}\n" for stack, hits in sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+# === MEMORY REPORT ===
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "1"))   # traceback depth tracemalloc keeps once `memory` turns it on
+MEMORY_WALK_CHUNK = 5000   # objects sized per event-loop turn
+
+async def deep_sizeof(obj, seen):
+    """Bytes reachable from obj, skipping anything whose id is already in `seen` (and adding what it counts).
+
+    Follows builtin containers and this module's own classes. Anything else
+    (discord.py models, tasks, connections, functions) is charged its shallow
+    size only, so a structure that holds a Member doesn't pull in the whole
+    client state. Yields to the loop every MEMORY_WALK_CHUNK objects, so the
+    result is an estimate over a structure that may change while it is walked.
+    """
+    size, stack, visited = 0, [obj], 0
+    while stack:
+        visited += 1
+        if visited % MEMORY_WALK_CHUNK == 0: await asyncio.sleep(0)
+        obj = stack.pop()
+        if id(obj) in seen: continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict): stack.extend(dict.keys(obj)); stack.extend(dict.values(obj))
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)): stack.extend(obj)
+        cls = type(obj)
+        if cls.__module__ != __name__: continue
+        if hasattr(obj, "__dict__"): stack.append(vars(obj))
+        for klass in cls.__mro__:
+            for slot in klass.__dict__.get("__slots__", ()):
+                if (value := getattr(obj, slot, None)) is not None: stack.append(value)
+    return size
+
+def bot_structures():
+    """(name, object) for everything the bot keeps resident. Stores come first so shared rows are charged to them."""
+    return [(db.name + "_db", db) for db in persistence.dbs.values()] + [
+        ("xp_cooldowns", xp_cooldowns), ("message_index", message_index), ("automod", automod),
+        ("guild_rules", guild_rules), ("guild_configs", guild_configs), ("permission_decisions", permission_decisions),
+        ("prefix_tables", prefix_tables), ("level_curves", level_curves), ("member_names", member_names),
+        ("outbound", outbound), ("xp_pipeline", xp_pipeline), ("reminders", reminders), ("expiries", expiries),
+        ("join_guard", join_guard), ("command_metrics", command_metrics), ("loop_lag", loop_lag),
+        ("guild_cache", guild_cache), ("persistence", persistence),
+    ]
+
+def entry_count(obj):
+    if isinstance(obj, GuildDB): return f"{len(obj)} guilds · {sum(len(guild) for guild in dict.values(obj)):,} rows"
+    return f"{len(obj):,}" if hasattr(obj, "__len__") else ""
+
+def discord_caches():
+    """(name, count) for the client caches discord.py keeps for us."""
+    guilds = bot.guilds
+    max_messages = getattr(bot._connection, "max_messages", None)
+    return [
+        ("guilds", len(guilds)),
+        ("members", sum(len(guild.members) for guild in guilds)),
+        ("users", len(bot.users)),
+        ("channels", sum(len(guild.channels) for guild in guilds)),
+        ("roles", sum(len(guild.roles) for guild in guilds)),
+        ("emojis", len(bot.emojis)),
+        ("messages", f"{len(bot.cached_messages)}/{max_messages}" if max_messages else len(bot.cached_messages)),
+    ]
+
+def process_rss():
+    """Current resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError): return None
+
+class AllocationTracker:
+    """tracemalloc snapshots diffed between `memory` invocations.
+
+    Tracing slows every allocation and adds its own bookkeeping, so it stays
+    off until the first `memory` call starts it and takes the baseline; each
+    later call reports what grew since the previous one. `memory off` stops it.
+    """
+    FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"), tracemalloc.Filter(False, "<unknown>"))
+
+    def __init__(self, frames=MEMORY_TRACE_FRAMES):
+        self.frames = frames
+        self.snapshot = None
+        self.taken = 0
+
+    def take(self):
+        return tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+
+    async def diff(self, n=10):
+        """None when this call started tracing, else (seconds since the last snapshot, top n StatisticDiffs by growth)."""
+        if not tracemalloc.is_tracing(): tracemalloc.start(self.frames)
+        snapshot, previous, taken = await asyncio.to_thread(self.take), self.snapshot, self.taken
+        self.snapshot, self.taken = snapshot, time.monotonic()
+        if previous is None: return None
+        stats = await asyncio.to_thread(snapshot.compare_to, previous, "lineno")
+        return self.taken - taken, [stat for stat in stats if stat.size_diff > 0][:n]
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshot = None
+
+allocations = AllocationTracker()
+
 # === HELPER FUNCTIONS ===
+def record_warning(guild, member, reason, issuer):
+    """Append a warning to the member's record and DM them. Returns their warning count."""
+    guild_warns = get_guild_data(warnings_db, guild.id)
+    user_id = str(member.id)
+    if user_id not in guild_warns: guild_warns[user_id] = {"count": 0, "reasons": []}
+    guild_warns[user_id]["count"] += 1
+    guild_warns[user_id]["reasons"].append(f"'{reason}' by {issuer} on {datetime.now().strftime('%Y-%m-%d')}")
+    mark_dirty(warnings_db, guild.id, user_id)
+    outbound.send(member, PRIO_MODERATION, f"You have been warned in **{guild.name}** for: **{reason}**.")
+    return guild_warns[user_id]["count"]
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(text):
+    """'30s', '10m', '1h' or '2d' -> seconds. Raises ValueError."""
+    if (unit := text[-1:].lower()) not in DURATION_UNITS: raise ValueError(text)
+    return int(text[:-1]) * DURATION_UNITS[unit]
+
 def create_progress_bar(current, total, length=10):
     if total == 0: total = 1
     percent = min(current / total, 1.0)
@@ -114,31 +2465,127 @@ def create_progress_bar(current, total, length=10):
     bar = "█" * filled_length + "░" * (length - filled_length)
     return f"[{bar}] {int(percent * 100)}%"
 
-async def process_xp(guild_id, user_id, channel, member):
-    guild_levels = get_guild_data(levels_db, guild_id)
-    user_data = guild_levels.get(user_id, {"xp": 0, "level": 1})
-    
-    leveled_up = False
-    while user_data["xp"] >= (user_data["level"] * 100):
-        user_data["xp"] -= user_data["level"] * 100
-        user_data["level"] += 1
-        leveled_up = True
-    
-    guild_levels[user_id] = user_data
-    if leveled_up:
-        embed = discord.Embed(title="🎉 LEVEL UP!", description=f"Congrats {member.mention}!", color=discord.Color.gold())
-        embed.add_field(name="New Level", value=f"**{user_data['level']}**")
-        embed.set_thumbnail(url=member.display_avatar.url)
-        await channel.send(embed=embed)
-    save_json("levels.json", levels_db)
+def apply_xp(guild_id, user_id, amount):
+    """Credit XP and return the new level if it went up, else None."""
+    old_level, level = get_guild_data(levels_db, guild_id).add_xp(user_id, amount)
+    mark_dirty(levels_db, guild_id, user_id)
+    return level if level > old_level else None
+
+def announce_level_up(channel, member, level):
+    outbound.coalesce(channel, PRIO_ANNOUNCE, "levelup", (member, level), render_level_ups)
+
+def process_xp(guild_id, user_id, channel, member, amount):
+    if level := apply_xp(guild_id, user_id, amount): announce_level_up(channel, member, level)
+
+XP_QUEUE_SIZE = int(os.getenv("XP_QUEUE_SIZE", "20000"))   # grants buffered before new ones are shed
+XP_BATCH_SIZE = int(os.getenv("XP_BATCH_SIZE", "512"))
+
+class XPPipeline:
+    """Decouples XP grants from message handling.
+
+    on_message only enqueues a grant; one worker drains the queue in batches,
+    applies every grant in the batch, marks the touched rows dirty for the
+    write-behind engine in one go, and hands level-ups to the outbound queue
+    so a slow send never holds up the next batch. When the queue is full,
+    new grants are shed and counted rather than blocking command dispatch.
+    """
+    def __init__(self, maxsize=XP_QUEUE_SIZE, batch_size=XP_BATCH_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.applied = self.dropped = self.batches = self.level_ups = 0
+        self.max_depth = 0
+        self._task = None
+
+    def submit(self, guild_id, user_id, amount, channel, member):
+        try: self.queue.put_nowait((guild_id, user_id, amount, channel, member))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def apply_batch(self, batch):
+        for guild_id, user_id, amount, channel, member in batch:
+            if level := apply_xp(guild_id, user_id, amount):
+                self.level_ups += 1
+                announce_level_up(channel, member, level)
+        self.applied += len(batch)
+        self.batches += 1
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty(): batch.append(self.queue.get_nowait())
+            try: self.apply_batch(batch)
+            except Exception as e: print(f"XP batch of {len(batch)} failed: {e}")
+            # Let message handlers run between batches during a flood.
+            await asyncio.sleep(0)
+
+    def start(self):
+        if not self._task: self._task = asyncio.create_task(self._run())
+
+    def summary(self):
+        avg = self.applied / self.batches if self.batches else 0.0
+        return f"depth {self.queue.qsize()}/{self.queue.maxsize} (peak {self.max_depth}) · {self.applied} applied in {self.batches} batches (avg {avg:.1f})\n{self.level_ups} level-ups · {self.dropped} shed"
+
+xp_pipeline = XPPipeline()
+
+OVERWRITE_CONCURRENCY = 5   # channel overwrite requests in flight at once
+OVERWRITE_RATE = 20.0       # overwrite requests started per second, well under the global limit
+PROGRESS_EVERY = 5.0        # seconds between progress edits on long runs
+
+def remember_muted_role(guild_id, role_id):
+    set_config(guild_id, muted_role=role_id)
+
+def muted_role(guild):
+    """The Muted role via the ID cached in config; scans roles by name only when that misses."""
+    if (role_id := guild_config(guild.id).muted_role) and (role := guild.get_role(role_id)): return role
+    if role := discord.utils.get(guild.roles, name="Muted"): remember_muted_role(guild.id, role.id)
+    return role
 
-async def create_muted_role(guild):
-    role = discord.utils.get(guild.roles, name="Muted")
-    if not role:
-        try:
-            role = await guild.create_role(name="Muted", reason="Bot Auto-Create Muted Role")
-            for channel in guild.text_channels: await channel.set_permissions(role, send_messages=False)
-        except discord.Forbidden: return None
+async def apply_overwrites(channels, role, progress=None, send_messages=False):
+    """Set send_messages for role in every channel, a few at a time and paced. Returns (done, failed)."""
+    limit, total = asyncio.Semaphore(OVERWRITE_CONCURRENCY), len(channels)
+    done = failed = 0
+    next_slot = reported = time.monotonic()
+
+    async def one(channel):
+        nonlocal done, failed, next_slot, reported
+        async with limit:
+            now = time.monotonic()
+            wait, next_slot = next_slot - now, max(now, next_slot) + 1 / OVERWRITE_RATE
+            if wait > 0: await asyncio.sleep(wait)
+            try:
+                await channel.set_permissions(role, send_messages=send_messages)
+                done += 1
+            except discord.HTTPException: failed += 1
+            if progress and time.monotonic() - reported >= PROGRESS_EVERY:
+                reported = time.monotonic()
+                await progress(done, total)
+
+    await asyncio.gather(*(one(channel) for channel in channels))
+    return done, failed
+
+async def lock_channels(channels, guild, locked, progress=None):
+    # None rather than True on unlock, so channels fall back to their category's setting.
+    return await apply_overwrites(channels, guild.default_role, progress, send_messages=False if locked else None)
+
+async def create_muted_role(guild, ctx=None):
+    if role := muted_role(guild): return role
+    try: role = await guild.create_role(name="Muted", reason="Bot Auto-Create Muted Role")
+    except discord.Forbidden: return None
+    remember_muted_role(guild.id, role.id)
+    channels = guild.text_channels
+    status = await ctx.send(f"⚙️ Setting up the Muted role in **{len(channels)}** channels...") if ctx and len(channels) > 25 else None
+
+    async def report(done, total):
+        try: await status.edit(content=f"⚙️ Setting up the Muted role: **{done}/{total}** channels...")
+        except discord.HTTPException: pass
+
+    done, failed = await apply_overwrites(channels, role, report if status else None)
+    if status:
+        try: await status.edit(content=f"✅ Muted role ready in **{done}/{len(channels)}** channels." + (f" Missing permissions in {failed}." if failed else ""))
+        except discord.HTTPException: pass
     return role
 
 def safe_math_eval(expr):
@@ -155,64 +2602,121 @@ def safe_math_eval(expr):
 # ==========================================
 # 🖥️ EVENTS
 # ==========================================
+@bot.event
+async def setup_hook():
+    loop_lag.start()
+    bot.health_server = await start_health_server()
+    persistence.start()
+    xp_pipeline.start()
+    reminders.start()
+    expiries.start()
+
 @bot.event
 async def on_ready():
     bot.uptime = datetime.now()
+    gateway.connected = gateway.ready_once = True
     print(f"\n┌{'─'*50}┐")
     print(f"  QueenAI Is Now Online!")
     print(f"  Logged in as: {bot.user}")
     print(f"└{'─'*50}┘\n")
     await bot.change_presence(activity=discord.Game(f"Type !tutorial to start!"))
 
+@bot.event
+async def on_resumed():
+    gateway.connected = True
+
+@bot.event
+async def on_disconnect():
+    if gateway.connected: gateway.disconnects += 1
+    gateway.connected = False
+
 @bot.event
 async def on_message(message):
     if message.author.bot or not message.guild: return
-    guild_id, user_id = str(message.guild.id), str(message.author.id)
-    current_time = time.time()
-    
-    guild_config = get_guild_data(config_db, guild_id)
-    cooldown_time = guild_config.get("xp_cooldown", 60)
-    cooldown_key = f"{guild_id}-{user_id}"
+    guild_id, user_id = message.guild.id, message.author.id
+    config = guild_config(guild_id)
+    cooldown_time = config.xp_cooldown
+    if config.automod and (reason := automod.check(guild_id, message.channel.id, user_id, message.content, len(message.mentions) + len(message.role_mentions))) and staff_level(message.guild, message.author) == STAFF_NONE:
+        # Spam earns no XP and runs no commands.
+        return automod.act(message, reason)
+    banned = response = None
+    if config.keyword_rules:
+        banned, response = rules_for(guild_id).scan(message.content)
+        if banned and staff_level(message.guild, message.author) == STAFF_NONE:
+            try: await message.delete()
+            except discord.HTTPException: pass
+            return outbound.send(message.channel, PRIO_MODERATION, f"🚫 {message.author.mention}, that word isn't allowed here.")
+    if config.message_index: message_index.add(message)
     
-    if cooldown_key not in xp_cooldowns or current_time > xp_cooldowns[cooldown_key]:
-        guild_levels = get_guild_data(levels_db, guild_id)
-        if user_id not in guild_levels: guild_levels[user_id] = {"xp": 0, "level": 1}
-        guild_levels[user_id]["xp"] += random.randint(10, 20)
-        xp_cooldowns[cooldown_key] = current_time + cooldown_time
-        await process_xp(guild_id, user_id, message.channel, message.author)
+    if xp_cooldowns.try_acquire(guild_id, user_id, cooldown_time):
+        xp_pipeline.submit(guild_id, user_id, random.randint(10, 20), message.channel, message.author)
     
-    await bot.process_commands(message)
+    # Ordinary chat can't be a command, so skip building a Context for it.
+    if prefix_table(guild_id).match(message.content) is None:
+        if response: outbound.send(message.channel, PRIO_FUN, response)
+        return
+    await bot.invoke(await bot.get_context(message, cls=LaneContext))
 
 @bot.event
 async def on_member_join(member):
-    guild_config = get_guild_data(config_db, member.guild.id)
-    if autorole_id := guild_config.get("autorole"):
+    config = guild_config(member.guild.id)
+    raid, started = join_guard.on_join(member)
+    if raid:
+        if started: await join_guard.start_raid(member.guild, raid)
+        if config.autorole and member.id not in raid.flagged and (role := member.guild.get_role(config.autorole)): join_guard.queue_autorole(member, role)
+        return
+    if autorole_id := config.autorole:
         if role := member.guild.get_role(autorole_id):
             try: await member.add_roles(role, reason="Autorole on join")
             except: pass # Ignore if permissions fail
-    if welcome_channel_id := guild_config.get("welcome_channel"):
-        if channel := member.guild.get_channel(welcome_channel_id):
-            embed = discord.Embed(title=f"Welcome to {member.guild.name}!", description=f"Hello {member.mention}, we're glad to have you! 🎉", color=discord.Color.green())
-            embed.set_thumbnail(url=member.display_avatar.url)
-            try: await channel.send(embed=embed)
-            except: pass
+    if welcome_channel_id := config.welcome_channel:
+        if channel := member.guild.get_channel(welcome_channel_id): outbound.coalesce(channel, PRIO_ANNOUNCE, "welcome", member, render_welcomes)
 
 @bot.event
 async def on_member_remove(member):
-    guild_config = get_guild_data(config_db, member.guild.id)
-    if goodbye_channel_id := guild_config.get("goodbye_channel"):
-        if channel := member.guild.get_channel(goodbye_channel_id):
-            embed = discord.Embed(description=f"**{member.display_name}** has left the server. Goodbye! 👋", color=discord.Color.red())
-            try: await channel.send(embed=embed)
-            except: pass
+    permission_decisions.pop((member.guild.id, member.id), None)
+    config = guild_config(member.guild.id)
+    if goodbye_channel_id := config.goodbye_channel:
+        if channel := member.guild.get_channel(goodbye_channel_id): outbound.coalesce(channel, PRIO_ANNOUNCE, "goodbye", member, render_goodbyes)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.roles != after.roles: permission_decisions.pop((after.guild.id, after.id), None)
+
+@bot.event
+async def on_guild_role_delete(role):
+    if role.id in guild_config(role.guild.id).staff_ids: invalidate_config(role.guild.id)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    # Keep new channels covered without re-running the whole setup.
+    if not isinstance(channel, discord.TextChannel): return
+    if (role_id := guild_config(channel.guild.id).muted_role) and (role := channel.guild.get_role(role_id)):
+        await apply_overwrites([channel], role)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_latency(ctx):
+    # Runs whether or not the command raised; failures are classified in on_command_error.
+    stats = command_metrics.stats(ctx.command.qualified_name)
+    stats.observe(time.perf_counter() - ctx.started_at)
+    if not ctx.command_failed: stats.outcomes["ok"] += 1
 
 @bot.event
 async def on_command_error(ctx, error):
+    if ctx.command:
+        outcome = ("check" if isinstance(error, commands.CheckFailure) else "cooldown" if isinstance(error, commands.CommandOnCooldown)
+                   else "usage" if isinstance(error, (commands.MissingRequiredArgument, commands.BadArgument)) else "error")
+        command_metrics.record(ctx.command.qualified_name, outcome)
     if isinstance(error, commands.CheckFailure): await ctx.send(f"❌ **Permission Denied:** {error}")
-    elif isinstance(error, commands.MissingRequiredArgument): await ctx.send(f"❌ **Missing Argument:** You forgot a required argument. Check `{get_prefix(bot, ctx.message)}{ctx.command.name}` usage.")
+    elif isinstance(error, commands.MissingRequiredArgument): await ctx.send(f"❌ **Missing Argument:** You forgot a required argument. Check `{display_prefix(ctx.message)}{ctx.command.name}` usage.")
     elif isinstance(error, commands.BadArgument): await ctx.send(f"❌ **Invalid Argument:** You provided an invalid user, role, or channel.")
     elif isinstance(error, commands.CommandOnCooldown): await ctx.send(f"⏰ This command is on cooldown. Try again in **{error.retry_after:.2f} seconds**.")
     elif isinstance(error, commands.CommandNotFound): pass
+    elif isinstance(error, LaneDropped): print(f"Reply to '{ctx.command}' dropped: {error}")   # the lane is saturated; don't queue another
     else:
         print(f"An unhandled error occurred in '{ctx.command}': {error}")
         await ctx.send("An unexpected error occurred. Please try again.")
@@ -223,59 +2727,55 @@ async def on_command_error(ctx, error):
 @bot.command()
 @commands.is_owner()
 async def setadminrole(ctx, role: discord.Role):
-    get_guild_data(config_db, ctx.guild.id)["admin_role"] = role.id
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, admin_role=role.id)
     await ctx.send(f"✅ **Admin Role Set!** Users with `{role.name}` can use admin commands.")
 
 @bot.command()
 @is_admin()
 async def setmodrole(ctx, role: discord.Role):
-    get_guild_data(config_db, ctx.guild.id)["mod_role"] = role.id
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, mod_role=role.id)
     await ctx.send(f"✅ **Moderator Role Set!** Users with `{role.name}` can use moderation commands.")
 
 @bot.command()
 @is_admin()
-async def setprefix(ctx, new_prefix: str):
-    if len(new_prefix) > 5: return await ctx.send("❌ Prefix cannot be longer than 5 characters.")
-    get_guild_data(config_db, ctx.guild.id)["prefix"] = new_prefix
-    save_json("config.json", config_db)
-    await ctx.send(f"✅ **Prefix Set!** My new prefix for this server is `{new_prefix}`.")
+async def setprefix(ctx, *new_prefixes: str):
+    if not new_prefixes: return await ctx.send("❌ Please give at least one prefix.")
+    if len(new_prefixes) > 5: return await ctx.send("❌ You can set at most 5 prefixes.")
+    if any(len(p) > 5 for p in new_prefixes): return await ctx.send("❌ Prefix cannot be longer than 5 characters.")
+    set_config(ctx.guild.id, prefix=new_prefixes[0], prefixes=list(new_prefixes))
+    await ctx.send(f"✅ **Prefix Set!** My prefixes for this server are now {', '.join(f'`{p}`' for p in new_prefixes)}.")
 
 @bot.command()
 @is_admin()
 async def setwelcomechannel(ctx, channel: discord.TextChannel):
-    get_guild_data(config_db, ctx.guild.id)["welcome_channel"] = channel.id
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, welcome_channel=channel.id)
     await ctx.send(f"✅ **Welcome Channel Set!** New members will be announced in {channel.mention}.")
 
 @bot.command()
 @is_admin()
 async def setgoodbyechannel(ctx, channel: discord.TextChannel):
-    get_guild_data(config_db, ctx.guild.id)["goodbye_channel"] = channel.id
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, goodbye_channel=channel.id)
     await ctx.send(f"✅ **Goodbye Channel Set!** Departures will be announced in {channel.mention}.")
 
 @bot.command()
 @is_admin()
 async def autorole(ctx, role: discord.Role):
-    get_guild_data(config_db, ctx.guild.id)["autorole"] = role.id
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, autorole=role.id)
     await ctx.send(f"✅ **Autorole Set!** New members will automatically get the `{role.name}` role.")
 
 @bot.command()
 @is_admin()
 async def configview(ctx):
-    guild_config = get_guild_data(config_db, ctx.guild.id)
-    prefix = guild_config.get("prefix", DEFAULT_PREFIX)
-    admin_role = ctx.guild.get_role(guild_config.get("admin_role"))
-    mod_role = ctx.guild.get_role(guild_config.get("mod_role"))
-    welcome_ch = ctx.guild.get_channel(guild_config.get("welcome_channel"))
-    goodbye_ch = ctx.guild.get_channel(guild_config.get("goodbye_channel"))
-    auto_role = ctx.guild.get_role(guild_config.get("autorole"))
+    config = guild_config(ctx.guild.id)
+    prefixes = config.prefixes
+    admin_role = ctx.guild.get_role(config.admin_role)
+    mod_role = ctx.guild.get_role(config.mod_role)
+    welcome_ch = ctx.guild.get_channel(config.welcome_channel)
+    goodbye_ch = ctx.guild.get_channel(config.goodbye_channel)
+    auto_role = ctx.guild.get_role(config.autorole)
 
     embed = discord.Embed(title=f"⚙️ Bot Configuration for {ctx.guild.name}", color=discord.Color.orange())
-    embed.add_field(name="Prefix", value=f"`{prefix}`", inline=False)
+    embed.add_field(name="Prefix", value=", ".join(f"`{p}`" for p in prefixes), inline=False)
     embed.add_field(name="Admin Role", value=admin_role.mention if admin_role else "Not Set", inline=False)
     embed.add_field(name="Moderator Role", value=mod_role.mention if mod_role else "Not Set", inline=False)
     embed.add_field(name="Welcome Channel", value=welcome_ch.mention if welcome_ch else "Not Set", inline=False)
@@ -287,10 +2787,7 @@ async def configview(ctx):
 @is_admin()
 async def resetserver(ctx):
     guild_id = str(ctx.guild.id)
-    if guild_id in warnings_db: del warnings_db[guild_id]
-    if guild_id in levels_db: del levels_db[guild_id]
-    if guild_id in money_db: del money_db[guild_id]
-    save_json("warnings.json", warnings_db); save_json("levels.json", levels_db); save_json("money.json", money_db)
+    for db in (warnings_db, levels_db, money_db): db.reset(guild_id)
     await ctx.send(f"🔄 **Server Data Reset!** All warnings, levels, and economy data for **{ctx.guild.name}** have been cleared.")
 
 @bot.command()
@@ -363,50 +2860,121 @@ async def createvoicechannel(ctx, *, channel_name: str):
 @bot.command()
 @is_admin()
 async def setlevel(ctx, member: discord.Member, level: int):
-    if level < 1: return await ctx.send("❌ Level must be 1 or higher.")
-    guild_levels = get_guild_data(levels_db, ctx.guild.id)
-    guild_levels[str(member.id)] = {"xp": 0, "level": level}
-    save_json("levels.json", levels_db)
+    if not (1 <= level <= MAX_LEVEL): return await ctx.send(f"❌ Level must be between 1 and {MAX_LEVEL:,}.")
+    get_guild_data(levels_db, ctx.guild.id).set_level(member.id, level)
+    mark_dirty(levels_db, ctx.guild.id, member.id)
     await ctx.send(f"👑 **Level Set:** {member.mention}'s level is now **{level}**.")
 
 @bot.command()
 @is_admin()
 async def givexp(ctx, member: discord.Member, amount: int):
     if amount <= 0: return await ctx.send("❌ XP amount must be positive.")
-    guild_levels = get_guild_data(levels_db, ctx.guild.id)
-    user_id = str(member.id)
-    if user_id not in guild_levels: guild_levels[user_id] = {"xp": 0, "level": 1}
-    guild_levels[user_id]["xp"] += amount
+    if amount > MAX_AMOUNT: return await ctx.send(f"❌ XP amount can be at most {MAX_AMOUNT:,}.")
     await ctx.send(f"👑 **XP Added:** Gave {member.mention} **{amount} XP**!")
-    await process_xp(ctx.guild.id, user_id, ctx.channel, member)
+    process_xp(ctx.guild.id, member.id, ctx.channel, member, amount)
 
 @bot.command()
 @is_admin()
 async def addmoney(ctx, member: discord.Member, amount: int):
-    guild_money = get_guild_data(money_db, ctx.guild.id)
+    if abs(amount) > MAX_AMOUNT: return await ctx.send(f"❌ Amount can be at most {MAX_AMOUNT:,}.")
     user_id = str(member.id)
-    guild_money[user_id] = guild_money.get(user_id, 0) + amount
-    save_json("money.json", money_db)
+    get_guild_data(money_db, ctx.guild.id).add(user_id, amount)
+    mark_dirty(money_db, ctx.guild.id, user_id)
     await ctx.send(f"👑 Added **{amount}** coins to {member.mention}'s balance.")
 
 @bot.command()
 @is_admin()
 async def removemoney(ctx, member: discord.Member, amount: int):
+    if abs(amount) > MAX_AMOUNT: return await ctx.send(f"❌ Amount can be at most {MAX_AMOUNT:,}.")
     guild_money = get_guild_data(money_db, ctx.guild.id)
     user_id = str(member.id)
-    current_bal = guild_money.get(user_id, 0)
-    guild_money[user_id] = max(0, current_bal - amount)
-    save_json("money.json", money_db)
+    guild_money.set_balance(user_id, max(0, guild_money.balance(user_id) - amount))
+    mark_dirty(money_db, ctx.guild.id, user_id)
     await ctx.send(f"👑 Removed **{amount}** coins from {member.mention}'s balance.")
 
 @bot.command()
 @is_admin()
 async def setxpcooldown(ctx, seconds: int):
     if not (10 <= seconds <= 300): return await ctx.send("❌ Cooldown must be between 10 and 300 seconds.")
-    get_guild_data(config_db, ctx.guild.id)["xp_cooldown"] = seconds
-    save_json("config.json", config_db)
+    set_config(ctx.guild.id, xp_cooldown=seconds)
     await ctx.send(f"⏳ XP earning cooldown set to **{seconds} seconds** for this server.")
 
+@bot.command()
+@is_admin()
+async def setlevelcurve(ctx, base: int, step: int):
+    if not (1 <= base <= 100000 and 0 <= step <= 100000): return await ctx.send("❌ Base must be 1-100000 and step 0-100000.")
+    # Totals are stored, not levels, so every member's level follows the new curve immediately: ask first.
+    if members := len(get_guild_data(levels_db, ctx.guild.id)):
+        await ctx.send(f"⚠️ This re-levels all **{members}** members with XP from their total XP. Levels may go up or down, and no level-up messages are sent. Reply `confirm` to proceed.")
+        try: await bot.wait_for('message', check=lambda m: m.author == ctx.author and m.channel == ctx.channel and m.content.lower() == "confirm", timeout=15.0)
+        except asyncio.TimeoutError: return await ctx.send("❌ Level curve change cancelled.")
+    set_config(ctx.guild.id, level_curve=[base, step])
+    if (guild_levels := dict.get(levels_db, str(ctx.guild.id))) is not None: guild_levels.curve = level_curve(ctx.guild.id)
+    await ctx.send(f"📈 **Level Curve Set!** Level L now needs **{base} + {step}×(L-1)** XP to reach L+1." + (f" Levels of {members} members were recalculated from their total XP." if members else ""))
+
+@bot.command()
+@is_admin()
+async def addbannedword(ctx, *, word: str):
+    word, rules = word.lower().strip(), rules_for(ctx.guild.id)
+    if not (0 < len(word) <= 100): return await ctx.send("❌ Banned words must be 1-100 characters.")
+    if len(rules) >= MAX_KEYWORD_RULES: return await ctx.send(f"❌ This server already has {MAX_KEYWORD_RULES} rules.")
+    rules.ban(word)
+    save_rules(ctx.guild.id, rules)
+    await ctx.send(f"🚫 **Banned Word Added!** ({len(rules.banned)} banned words)")
+
+@bot.command()
+@is_admin()
+async def removebannedword(ctx, *, word: str):
+    rules = rules_for(ctx.guild.id)
+    if word.lower().strip() not in rules.banned: return await ctx.send("❌ That word isn't banned.")
+    rules.unban(word.lower().strip())
+    save_rules(ctx.guild.id, rules)
+    await ctx.send(f"✅ **Banned Word Removed!** ({len(rules.banned)} banned words)")
+
+@bot.command()
+@is_admin()
+async def addresponse(ctx, trigger: str, *, response: str):
+    trigger, rules = trigger.lower().strip(), rules_for(ctx.guild.id)
+    if not (0 < len(trigger) <= 100 and len(response) <= 500): return await ctx.send("❌ Triggers must be 1-100 characters and responses at most 500.")
+    if len(rules) >= MAX_KEYWORD_RULES and trigger not in rules.responses: return await ctx.send(f"❌ This server already has {MAX_KEYWORD_RULES} rules.")
+    rules.set_response(trigger, response)
+    save_rules(ctx.guild.id, rules)
+    await ctx.send(f"💬 **Auto-Response Set!** Messages containing `{trigger}` will get a reply.")
+
+@bot.command()
+@is_admin()
+async def removeresponse(ctx, *, trigger: str):
+    rules = rules_for(ctx.guild.id)
+    if trigger.lower().strip() not in rules.responses: return await ctx.send("❌ No auto-response uses that trigger.")
+    rules.drop_response(trigger.lower().strip())
+    save_rules(ctx.guild.id, rules)
+    await ctx.send("✅ **Auto-Response Removed!**")
+
+@bot.command()
+@is_admin()
+async def setraidlockdown(ctx, state: str):
+    if state.lower() not in ("on", "off"): return await ctx.send("❌ Use `on` or `off`.")
+    enabled = state.lower() == "on"
+    set_config(ctx.guild.id, raid_lockdown=enabled)
+    await ctx.send(f"🚨 **Raid Lockdown {'Enabled' if enabled else 'Disabled'}!** " + ("Every open text channel will be locked when a join raid is detected, until a moderator runs `endraid`." if enabled else "Raids will no longer lock channels."))
+
+@bot.command()
+@is_admin()
+async def setautomod(ctx, state: str):
+    if state.lower() not in ("on", "off"): return await ctx.send("❌ Use `on` or `off`.")
+    enabled = state.lower() == "on"
+    set_config(ctx.guild.id, automod=enabled)
+    await ctx.send(f"🛡️ **Automod {'Enabled' if enabled else 'Disabled'}!** " + ("Message floods, repeated messages and mass mentions will be removed; offenders are warned, then timed out." if enabled else "Spam checks are off."))
+
+@bot.command()
+@is_admin()
+async def setmessageindex(ctx, state: str):
+    if state.lower() not in ("on", "off"): return await ctx.send("❌ Use `on` or `off`.")
+    enabled = state.lower() == "on"
+    set_config(ctx.guild.id, message_index=enabled)
+    if not enabled: message_index.drop_guild(ctx.guild.id)
+    await ctx.send(f"🗂️ **Message Index {'Enabled' if enabled else 'Disabled'}!** " + (f"`count` and `search` now answer from the last {CHANNEL_BUFFER_SIZE} messages per channel." if enabled else "Recent messages are no longer kept in memory."))
+
 # ==========================================
 # 🛡️ MODERATION COMMANDS (Requires Moderator Role)
 # ==========================================
@@ -416,20 +2984,11 @@ async def warn(ctx, member: discord.Member, *, reason="No reason provided"):
     if member.top_role >= ctx.author.top_role and ctx.author != ctx.guild.owner: return await ctx.send("❌ You cannot warn a member with an equal or higher role.")
     if member == ctx.author or member.bot: return await ctx.send("❌ You cannot warn yourself or a bot.")
     
-    guild_warns = get_guild_data(warnings_db, ctx.guild.id)
-    user_id = str(member.id)
-    if user_id not in guild_warns: guild_warns[user_id] = {"count": 0, "reasons": []}
-    guild_warns[user_id]["count"] += 1
-    guild_warns[user_id]["reasons"].append(f"'{reason}' by {ctx.author.name} on {datetime.now().strftime('%Y-%m-%d')}")
-    save_json("warnings.json", warnings_db)
-    
-    count = guild_warns[user_id]["count"]
+    count = record_warning(ctx.guild, member, reason, ctx.author.name)
     embed = discord.Embed(title="⚠️ WARNING ISSUED", description=f"**Reason:** {reason}", color=discord.Color.red())
     embed.add_field(name="User", value=member.mention)
     embed.add_field(name="Total Warnings", value=f"**{count}**")
     await ctx.send(embed=embed)
-    try: await member.send(f"You have been warned in **{ctx.guild.name}** for: **{reason}**.")
-    except: pass
 
 @bot.command(aliases=["unwarn", "removewarn"])
 @is_moderator()
@@ -440,15 +2999,14 @@ async def rmwarn(ctx, member: discord.Member):
         guild_warns[user_id]["count"] -= 1
         removed_reason = guild_warns[user_id]["reasons"].pop()
         if guild_warns[user_id]["count"] == 0: del guild_warns[user_id]
-        save_json("warnings.json", warnings_db)
+        mark_dirty(warnings_db, ctx.guild.id, user_id)
         await ctx.send(f"✅ Removed one warning for {member.mention}. (Last reason was: {removed_reason})")
     else: await ctx.send("❌ This user has no warnings to remove.")
 
 @bot.command(aliases=["warns"])
 async def checkwarns(ctx, member: discord.Member = None):
     member = member or ctx.author
-    guild_warns = get_guild_data(warnings_db, ctx.guild.id)
-    data = guild_warns.get(str(member.id), {"count": 0, "reasons": []})
+    data = read_row(warnings_db, ctx.guild.id, member.id, {"count": 0, "reasons": []})
     embed = discord.Embed(title=f"Warnings for {member.display_name}", color=discord.Color.orange())
     embed.add_field(name="Total Warnings", value=str(data['count']))
     reasons = "\n".join([f"- {r}" for r in data["reasons"][-5:]]) if data["reasons"] else "Clean record! ✨"
@@ -462,24 +3020,40 @@ async def clearwarns(ctx, member: discord.Member):
     user_id = str(member.id)
     if user_id in guild_warns and guild_warns[user_id]["count"] > 0:
         del guild_warns[user_id]
-        save_json("warnings.json", warnings_db)
+        mark_dirty(warnings_db, ctx.guild.id, user_id)
         await ctx.send(f"✨ All warnings for {member.mention} have been cleared.")
     else: await ctx.send("This user already has a clean record.")
 
 @bot.command()
 @is_moderator()
 async def mute(ctx, member: discord.Member, *, reason="No reason provided"):
-    role = await create_muted_role(ctx.guild)
+    role = await create_muted_role(ctx.guild, ctx)
     if not role: return await ctx.send("❌ Could not find or create the 'Muted' role. Check my permissions.")
     try:
         await member.add_roles(role, reason=reason)
+        expiries.cancel(ctx.guild.id, "mute", member.id)   # a permanent mute replaces any running tempmute
         await ctx.send(f"🤐 **Muted:** {member.mention} | Reason: {reason}")
     except discord.Forbidden: await ctx.send("❌ I don't have permission to assign the 'Muted' role.")
 
+@bot.command()
+@is_moderator()
+async def tempmute(ctx, member: discord.Member, duration: str, *, reason="No reason provided"):
+    try: seconds = parse_duration(duration)
+    except ValueError: return await ctx.send("❌ Invalid duration. Use `30m`, `12h` or `7d`.")
+    if seconds <= 0: return await ctx.send("❌ Duration must be a positive number.")
+    role = await create_muted_role(ctx.guild, ctx)
+    if not role: return await ctx.send("❌ Could not find or create the 'Muted' role. Check my permissions.")
+    try:
+        await member.add_roles(role, reason=f"Tempmute ({duration}): {reason}")
+        expiries.schedule(ctx.guild.id, "mute", member.id, seconds, reason)
+        await ctx.send(f"🤐 **Muted:** {member.mention} for **{duration}** | Reason: {reason}")
+    except discord.Forbidden: await ctx.send("❌ I don't have permission to assign the 'Muted' role.")
+
 @bot.command()
 @is_moderator()
 async def unmute(ctx, member: discord.Member):
-    role = discord.utils.get(ctx.guild.roles, name="Muted")
+    role = muted_role(ctx.guild)
+    expiries.cancel(ctx.guild.id, "mute", member.id)
     if role and role in member.roles:
         try:
             await member.remove_roles(role, reason="Unmuted by command")
@@ -510,12 +3084,26 @@ async def kick(ctx, member: discord.Member, *, reason="No reason provided"):
 async def ban(ctx, member: discord.Member, *, reason="No reason provided"):
     try:
         await member.ban(reason=reason)
+        expiries.cancel(ctx.guild.id, "ban", member.id)   # a permanent ban replaces any running tempban
         await ctx.send(f"🔨 **Banned:** {member.mention} | Reason: {reason}")
     except discord.Forbidden: await ctx.send(f"❌ I can't ban this member. My role is likely lower than theirs.")
 
+@bot.command()
+@is_moderator()
+async def tempban(ctx, member: discord.Member, duration: str, *, reason="No reason provided"):
+    try: seconds = parse_duration(duration)
+    except ValueError: return await ctx.send("❌ Invalid duration. Use `30m`, `12h` or `7d`.")
+    if seconds <= 0: return await ctx.send("❌ Duration must be a positive number.")
+    try:
+        await member.ban(reason=f"Tempban ({duration}): {reason}")
+        expiries.schedule(ctx.guild.id, "ban", member.id, seconds, reason)
+        await ctx.send(f"🔨 **Banned:** {member.mention} for **{duration}** | Reason: {reason}")
+    except discord.Forbidden: await ctx.send(f"❌ I can't ban this member. My role is likely lower than theirs.")
+
 @bot.command()
 @is_moderator()
 async def unban(ctx, user_id: int, *, reason="No reason provided"):
+    expiries.cancel(ctx.guild.id, "ban", user_id)
     try:
         user = await bot.fetch_user(user_id)
         await ctx.guild.unban(user, reason=reason)
@@ -551,16 +3139,41 @@ async def slowmode(ctx, seconds: int):
 @is_moderator()
 async def lock(ctx, channel: discord.TextChannel = None):
     channel = channel or ctx.channel
-    await channel.set_permissions(ctx.guild.default_role, send_messages=False)
+    if (await lock_channels([channel], ctx.guild, True))[1]: return await ctx.send("❌ I don't have permission to edit that channel.")
     await ctx.send(f"🔒 **CHANNEL LOCKED:** {channel.mention}.")
 
 @bot.command()
 @is_moderator()
 async def unlock(ctx, channel: discord.TextChannel = None):
     channel = channel or ctx.channel
-    await channel.set_permissions(ctx.guild.default_role, send_messages=None) # Use None to reset to default
+    if (await lock_channels([channel], ctx.guild, False))[1]: return await ctx.send("❌ I don't have permission to edit that channel.")
     await ctx.send(f"🔓 **CHANNEL UNLOCKED:** {channel.mention}.")
 
+@bot.command()
+@is_moderator()
+async def raidlist(ctx):
+    if not (raid := join_guard.raids.get(ctx.guild.id)): return await ctx.send("✅ No raid has been detected here.")
+    embed = discord.Embed(title=f"🚨 Raid {'in progress' if raid.active else 'over'}", description=f"**{raid.joined}** joins during the raid, **{len(raid.flagged)}** flagged as suspicious.", color=discord.Color.red())
+    if raid.flagged: embed.add_field(name="Flagged (first 20)", value="\n".join(f"`{uid}` {name}" for uid, name in list(raid.flagged.items())[:20]), inline=False)
+    if raid.locked: embed.add_field(name="Lockdown", value=f"{len(raid.locked)} channels locked until `endraid`.", inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command()
+@is_admin()
+async def raidban(ctx, *, reason="Raid"):
+    if not (raid := join_guard.raids.get(ctx.guild.id)) or not raid.flagged: return await ctx.send("✅ There are no flagged accounts to ban.")
+    await ctx.send(f"🔨 Banning **{len(raid.flagged)}** flagged accounts...")
+    banned, failed = await join_guard.ban_flagged(ctx.guild, raid, reason)
+    await ctx.send(f"🔨 **Raid Ban Complete:** {banned} banned" + (f", {failed} failed." if failed else "."))
+
+@bot.command()
+@is_moderator()
+async def endraid(ctx):
+    if not (raid := join_guard.raids.get(ctx.guild.id)) or not raid.active: return await ctx.send("✅ Raid mode is not active.")
+    unlocking = len(raid.locked)
+    await join_guard.end_raid(ctx.guild, raid)
+    await ctx.send("🛡️ **Raid mode ended.**" + (f" Unlocked {unlocking} channels." if unlocking else ""))
+
 @bot.command()
 @is_moderator()
 async def nickname(ctx, member: discord.Member, *, nick: str):
@@ -579,56 +3192,56 @@ async def resetnick(ctx, member: discord.Member):
 @bot.command(aliases=["rank", "level"])
 async def stats(ctx, member: discord.Member = None):
     member = member or ctx.author
-    guild_levels = get_guild_data(levels_db, ctx.guild.id)
-    data = guild_levels.get(str(member.id), {"xp": 0, "level": 1})
-    xp, lvl = data["xp"], data["level"]
-    needed = lvl * 100
+    row = read_row(levels_db, ctx.guild.id, member.id)
+    total = LevelTable.decode(row)[0] if row else 0
+    lvl, xp, needed = level_curve(ctx.guild.id).progress(total)
+    rank, ranked = await xp_rank(ctx.guild.id, member.id, total) if row else (None, 0)
     bar = create_progress_bar(xp, needed)
     
     embed = discord.Embed(title=f"📊 Rank Card: {member.display_name}", color=discord.Color.purple())
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.add_field(name="Level", value=str(lvl), inline=True)
     embed.add_field(name="XP", value=f"{xp} / {needed}", inline=True)
+    embed.add_field(name="Rank", value=f"#{rank} of {ranked}" if rank else "Unranked", inline=True)
     embed.add_field(name="Progress", value=f"`{bar}`", inline=False)
     await ctx.send(embed=embed)
 
 @bot.command(aliases=["lb"])
-async def leaderboard(ctx):
+async def leaderboard(ctx, page: int = 1):
     guild_levels = get_guild_data(levels_db, ctx.guild.id)
-    sorted_users = sorted(guild_levels.items(), key=lambda x: (x[1]['level'], x[1]['xp']), reverse=True)[:10]
+    pages = max(1, -(-len(guild_levels) // 10))
+    if not (1 <= page <= pages): return await ctx.send(f"❌ Page must be between 1 and {pages}.")
+    top_users = guild_levels.page((page - 1) * 10, 10)
+    names = await member_names.resolve(ctx.guild, [uid for uid, _, _ in top_users])
     desc = ""
-    for i, (uid, data) in enumerate(sorted_users, 1):
-        try: member = await ctx.guild.fetch_member(int(uid)); name = member.display_name
-        except: name = f"User Left (ID: {uid})"
-        desc += f"**{i}.** {name} - Lvl {data['level']} ({data['xp']} XP)\n"
+    for i, (uid, xp, level) in enumerate(top_users, (page - 1) * 10 + 1):
+        desc += f"**{i}.** {leaderboard_name(uid, names[uid])} - Lvl {level} ({xp} XP)\n"
     embed = discord.Embed(title=f"🏆 XP LEADERBOARD - {ctx.guild.name}", description=desc or "No one has earned XP yet!", color=discord.Color.gold())
+    embed.set_footer(text=f"Page {page}/{pages} · {len(guild_levels)} ranked members")
     await ctx.send(embed=embed)
 
 @bot.command(aliases=['bal'])
 async def balance(ctx, member: discord.Member = None):
     member = member or ctx.author
-    guild_money = get_guild_data(money_db, ctx.guild.id)
-    bal = guild_money.get(str(member.id), 0)
+    bal = read_row(money_db, ctx.guild.id, member.id, 0)
     await ctx.send(f"💰 **{member.display_name}** has **{bal}** coins.")
 
 @bot.command()
 @commands.cooldown(1, 86400, commands.BucketType.user)
 async def daily(ctx):
-    guild_money = get_guild_data(money_db, ctx.guild.id)
     user_id = str(ctx.author.id)
     reward = random.randint(250, 750)
-    guild_money[user_id] = guild_money.get(user_id, 0) + reward
-    save_json("money.json", money_db)
+    get_guild_data(money_db, ctx.guild.id).add(user_id, reward)
+    mark_dirty(money_db, ctx.guild.id, user_id)
     await ctx.send(f"💵 You collected your daily reward of **{reward}** coins!")
 
 @bot.command()
 @commands.cooldown(1, 3600, commands.BucketType.user)
 async def work(ctx):
-    guild_money = get_guild_data(money_db, ctx.guild.id)
     user_id = str(ctx.author.id)
     earnings = random.randint(100, 300)
-    guild_money[user_id] = guild_money.get(user_id, 0) + earnings
-    save_json("money.json", money_db)
+    get_guild_data(money_db, ctx.guild.id).add(user_id, earnings)
+    mark_dirty(money_db, ctx.guild.id, user_id)
     job = random.choice(["coding a Discord bot", "serving lugaw", "driving a jeepney", "selling fishball"])
     await ctx.send(f"💼 You earned **{earnings}** coins by {job}!")
 
@@ -640,13 +3253,13 @@ async def transfer(ctx, member: discord.Member, amount: int):
     
     guild_money = get_guild_data(money_db, ctx.guild.id)
     sender_id, receiver_id = str(ctx.author.id), str(member.id)
-    sender_bal = guild_money.get(sender_id, 0)
+    sender_bal = guild_money.balance(sender_id)
 
     if sender_bal < amount: return await ctx.send(f"❌ You don't have enough coins. Your balance: **{sender_bal}**.")
     
-    guild_money[sender_id] -= amount
-    guild_money[receiver_id] = guild_money.get(receiver_id, 0) + amount
-    save_json("money.json", money_db)
+    guild_money.add(sender_id, -amount)
+    guild_money.add(receiver_id, amount)
+    mark_dirty(money_db, ctx.guild.id, sender_id); mark_dirty(money_db, ctx.guild.id, receiver_id)
     await ctx.send(f"💸 Successfully transferred **{amount}** coins to {member.mention}.")
 
 @bot.command()
@@ -656,20 +3269,18 @@ async def beg(ctx):
     user_id = str(ctx.author.id)
     if random.random() < 0.6: # 60% success
         earnings = random.randint(10, 50)
-        guild_money[user_id] = guild_money.get(user_id, 0) + earnings
-        save_json("money.json", money_db)
+        guild_money.add(user_id, earnings)
+        mark_dirty(money_db, ctx.guild.id, user_id)
         await ctx.send(f"🙏 A kind stranger gave you **{earnings}** coins.")
     else: await ctx.send("😔 No one gave you anything. Better luck next time.")
 
 @bot.command()
 async def richestrank(ctx):
-    guild_money = get_guild_data(money_db, ctx.guild.id)
-    sorted_users = sorted(guild_money.items(), key=lambda x: x[1], reverse=True)[:10]
+    top_users = get_guild_data(money_db, ctx.guild.id).top(10)
+    names = await member_names.resolve(ctx.guild, [uid for uid, _ in top_users])
     desc = ""
-    for i, (uid, amount) in enumerate(sorted_users, 1):
-        try: member = await ctx.guild.fetch_member(int(uid)); name = member.display_name
-        except: name = f"User Left (ID: {uid})"
-        desc += f"**{i}.** {name} - {amount} Coins\n"
+    for i, (uid, amount) in enumerate(top_users, 1):
+        desc += f"**{i}.** {leaderboard_name(uid, names[uid])} - {amount} Coins\n"
     embed = discord.Embed(title=f"💸 WEALTHIEST USERS - {ctx.guild.name}", description=desc or "No one has any money yet!", color=discord.Color.green())
     await ctx.send(embed=embed)
 
@@ -719,11 +3330,11 @@ async def poll(ctx, *, question: str):
 @bot.command(aliases=["8ball"])
 async def ask(ctx, *, question: str):
     responses = ["It is certain.", "Without a doubt.", "Yes, definitely.", "As I see it, yes.", "Most likely.", "Outlook good.", "Signs point to yes.", "Reply hazy, try again.", "Ask again later.", "Cannot predict now.", "Don't count on it.", "My reply is no.", "Outlook not so good.", "Very doubtful."]
-    await ctx.send(f"🎱 **Question:** {question}\n**Answer:** {random.choice(responses)}")
+    fun_reply(ctx, f"🎱 **Question:** {question}\n**Answer:** {random.choice(responses)}")
 
 @bot.command()
 async def coinflip(ctx):
-    await ctx.send(f"🪙 The coin landed on: **{random.choice(['Heads', 'Tails'])}**")
+    fun_reply(ctx, f"🪙 The coin landed on: **{random.choice(['Heads', 'Tails'])}**")
 
 @bot.command()
 async def latency(ctx):
@@ -732,7 +3343,7 @@ async def latency(ctx):
 @bot.command()
 async def dice(ctx, sides: int = 6):
     if sides < 2: return await ctx.send("❌ A dice must have at least 2 sides.")
-    await ctx.send(f"🎲 You rolled a d{sides} and got: **{random.randint(1, sides)}**")
+    fun_reply(ctx, f"🎲 You rolled a d{sides} and got: **{random.randint(1, sides)}**")
 
 @bot.command(aliases=['botinfo'])
 async def whoami(ctx):
@@ -745,7 +3356,7 @@ async def whoami(ctx):
 @bot.command()
 async def choose(ctx, *choices: str):
     if len(choices) < 2: return await ctx.send("❌ Please provide at least two options separated by spaces.")
-    await ctx.send(f"🤔 Out of your choices, I pick: **{random.choice(choices)}**")
+    fun_reply(ctx, f"🤔 Out of your choices, I pick: **{random.choice(choices)}**")
 
 @bot.command()
 async def roll(ctx, dice_string: str = "1d6"):
@@ -760,17 +3371,17 @@ async def roll(ctx, dice_string: str = "1d6"):
 async def weather(ctx, *, city: str):
     conditions = ["Sunny ☀️", "Cloudy ☁️", "Rainy 🌧️", "Stormy ⛈️", "Windy 💨"]
     temp = random.randint(18, 35)
-    await ctx.send(f"**Weather for {city.title()}:** **{random.choice(conditions)}** at **{temp}°C**.")
+    fun_reply(ctx, f"**Weather for {city.title()}:** **{random.choice(conditions)}** at **{temp}°C**.")
 
 @bot.command()
 async def hug(ctx, member: discord.Member):
     if member == ctx.author: return await ctx.send("You can't hug yourself, but I can! 🤗")
-    await ctx.send(f"🤗 {ctx.author.mention} gives {member.mention} a big, warm hug!")
+    fun_reply(ctx, f"🤗 {ctx.author.mention} gives {member.mention} a big, warm hug!")
 
 @bot.command()
 async def slap(ctx, member: discord.Member):
     if member == bot.user: return await ctx.send("Ouch! Why would you do that to me? 😢")
-    await ctx.send(f"✋ {ctx.author.mention} slaps {member.mention} with a large trout!")
+    fun_reply(ctx, f"✋ {ctx.author.mention} slaps {member.mention} with a large trout!")
 
 @bot.command(aliases=['ship'])
 async def pairing(ctx, member1: discord.Member, member2: discord.Member):
@@ -791,11 +3402,11 @@ async def color(ctx, hex_code: str = None):
 @bot.command(aliases=['inspire'])
 async def quote(ctx):
     quotes = ["The only way to do great work is to love what you do.", "The mind is everything. What you think you become.", "You miss 100% of the shots you don't take.", "The best time to plant a tree was 20 years ago. The second best time is now."]
-    await ctx.send(f"💬 *{random.choice(quotes)}*")
+    fun_reply(ctx, f"💬 *{random.choice(quotes)}*")
 
 @bot.command(aliases=['reverse'])
 async def backwards(ctx, *, text: str):
-    await ctx.send(f"sdrawkcab si **{text[::-1]}**")
+    fun_reply(ctx, f"sdrawkcab si **{text[::-1]}**")
 
 @bot.command()
 async def math(ctx, *, expression: str):
@@ -805,19 +3416,15 @@ async def math(ctx, *, expression: str):
     except Exception as e: await ctx.send(f"❌ Invalid expression. Error: {e}")
 
 @bot.command()
+@commands.guild_only()
 async def remind(ctx, time_str: str, *, reminder: str):
     try:
-        if 'm' in time_str: seconds, unit = int(time_str.strip('m')) * 60, "minutes"
-        elif 'h' in time_str: seconds, unit = int(time_str.strip('h')) * 3600, "hours"
-        elif 's' in time_str: seconds, unit = int(time_str.strip('s')), "seconds"
-        else: raise ValueError
-        if not (0 < seconds <= 86400): return await ctx.send("❌ Reminder must be between 1s and 24h.")
-    except ValueError: return await ctx.send("❌ Invalid time format. Use `30s`, `10m`, or `1h`.")
+        seconds = parse_duration(time_str)
+        if not (0 < seconds <= REMINDER_MAX_DAYS * 86400): return await ctx.send(f"❌ Reminder must be between 1s and {REMINDER_MAX_DAYS}d.")
+    except ValueError: return await ctx.send("❌ Invalid time format. Use `30s`, `10m`, `1h` or `2d`.")
     
+    reminders.add(ctx.guild.id, ctx.author.id, ctx.channel.id, time.time() + seconds, reminder)
     await ctx.send(f"✅ Okay, {ctx.author.mention}, I'll remind you in **{time_str}** about: `{reminder}`")
-    await asyncio.sleep(seconds)
-    try: await ctx.author.send(f"⏰ **Reminder from {ctx.guild.name}:**\n> {reminder}")
-    except discord.Forbidden: await ctx.send(f"⏰ {ctx.author.mention}, your reminder is up! `{reminder}`")
 
 @bot.command()
 @is_moderator()
@@ -832,12 +3439,32 @@ async def embed(ctx, title: str, color_hex: str, *, description: str):
 
 @bot.command()
 async def count(ctx, *, word: str):
+    if buffer := message_index.buffer(ctx.channel.id):
+        seen = min(MESSAGE_WINDOW, len(buffer.messages))
+        counter = len(buffer.matches(tuple(WORD_RE.findall(word.lower())), MESSAGE_WINDOW))
+        return await ctx.send(f"🔢 The word/phrase '**{word}**' appeared **{counter}** times in the last {seen} messages.")
     target = word.lower()
     counter = 0
     async for message in ctx.channel.history(limit=200):
         if not message.author.bot and target in message.content.lower(): counter += 1
     await ctx.send(f"🔢 The word/phrase '**{word}**' appeared **{counter}** times in the last 200 messages.")
 
+@bot.command()
+async def search(ctx, *, words: str):
+    if not (buffer := message_index.buffer(ctx.channel.id)):
+        return await ctx.send(f"❌ Message search is off here. An admin can enable it with `{display_prefix(ctx.message)}setmessageindex on`.")
+    phrase = tuple(WORD_RE.findall(words.lower()))
+    # Skip the search command itself, which is the newest message in the buffer.
+    hits = [seq for seq in buffer.matches(phrase, CHANNEL_BUFFER_SIZE) if buffer.messages[seq - buffer.base][0] != ctx.message.id]
+    if not hits: return await ctx.send(f"🔍 No recent messages contain '**{words}**'.")
+    lines = []
+    for seq in hits[:5]:
+        message_id, author_id, tokens = buffer.messages[seq - buffer.base]
+        snippet = " ".join(tokens)
+        if len(snippet) > 90: snippet = snippet[:90] + "…"
+        lines.append(f"<@{author_id}>: [{snippet}](https://discord.com/channels/{ctx.guild.id}/{ctx.channel.id}/{message_id})")
+    await ctx.send(embed=discord.Embed(title=f"🔍 '{words}' — {len(hits)} recent matches", description="\n".join(lines), color=discord.Color.blue()))
+
 @bot.command(aliases=['botstats'])
 async def bottats(ctx):
     delta = datetime.now() - bot.uptime
@@ -848,14 +3475,71 @@ async def bottats(ctx):
     embed.add_field(name="Servers", value=len(bot.guilds), inline=True)
     embed.add_field(name="Total Users", value=len(bot.users), inline=True)
     embed.add_field(name="Uptime", value=f"{hours}h {minutes}m {seconds}s", inline=False)
+    embed.add_field(name="Event Loop", value=loop_lag.summary(), inline=False)
+    embed.add_field(name="Persistence", value=persistence.summary(), inline=False)
+    embed.add_field(name="Guild Cache", value=guild_cache.summary(), inline=False)
+    embed.add_field(name="Name Cache", value=member_names.summary(), inline=False)
+    embed.add_field(name="XP Cooldowns", value=xp_cooldowns.summary(), inline=False)
+    embed.add_field(name="XP Pipeline", value=xp_pipeline.summary(), inline=False)
+    embed.add_field(name="Outbound", value=outbound.summary(), inline=False)
+    embed.add_field(name="Reminders", value=reminders.summary(), inline=False)
+    embed.add_field(name="Temp Punishments", value=expiries.summary(), inline=False)
+    embed.add_field(name="Message Index", value=message_index.summary(), inline=False)
+    embed.add_field(name="Automod", value=automod.summary(), inline=False)
+    embed.add_field(name="Raid Protection", value=join_guard.summary(), inline=False)
+    embed.add_field(name="Slowest Commands (by p95)", value=command_metrics.summary(), inline=False)
     await ctx.send(embed=embed)
 
+# ==========================================
+# 🔬 OWNER DIAGNOSTICS
+# ==========================================
+@bot.command()
+@commands.is_owner()
+async def profile(ctx, seconds: int = 10):
+    if not (1 <= seconds <= PROFILE_MAX_SECONDS): return await ctx.send(f"❌ Profile for 1-{PROFILE_MAX_SECONDS} seconds.")
+    if getattr(bot, "profiling", False): return await ctx.send("❌ A profile is already running.")
+    bot.profiling = True
+    await ctx.send(f"🔬 Sampling the event loop at {PROFILE_HZ} Hz for **{seconds}s**...")
+    try: sampler = await StackSampler().run(seconds)
+    finally: bot.profiling = False
+    busy = sampler.samples - sampler.idle
+    if not busy: return await ctx.send(f"😴 No busy samples in {seconds}s ({sampler.mode} sampler).")
+    rows = [f"{own / busy:6.1%} {total / busy:6.1%}  {function[:70]}" for own, total, function in sampler.top()]
+    table = "\n".join([f"  self  total  function ({busy} busy samples via {sampler.mode}, {sampler.idle} idle)"] + rows)
+    folded = discord.File(io.BytesIO(sampler.collapsed().encode("utf-8")), filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+    await ctx.send(f"```\n{table[:1900]}\n```", file=folded)
+
+@bot.command()
+@commands.is_owner()
+async def memory(ctx, action: str = None):
+    if action == "off":
+        if not tracemalloc.is_tracing(): return await ctx.send("❌ Allocation tracing isn't running.")
+        allocations.stop()
+        return await ctx.send("🧠 Allocation tracing stopped.")
+    seen, rows = set(), []
+    for name, obj in bot_structures():
+        rows.append((await deep_sizeof(obj, seen), name, entry_count(obj)))
+    rows.sort(reverse=True)
+    rss = process_rss()
+    lines = [f"{'structure':<22}{'size':>10}  entries"] + [f"{name:<22}{size / 1024:>8.0f}KB  {count}" for size, name, count in rows]
+    lines += [f"{'total':<22}{sum(row[0] for row in rows) / 1048576:>8.1f}MB  of {rss / 1048576:.0f} MB resident" if rss else f"{'total':<22}{sum(row[0] for row in rows) / 1048576:>8.1f}MB", ""]
+    lines += ["discord.py caches: " + " · ".join(f"{count} {name}" for name, count in discord_caches())]
+    await ctx.send(f"🧠 **Memory report**\n```\n{chr(10).join(lines)[:1900]}\n```")
+    del seen   # the id set is as big as the structures walked; keep it out of the snapshot
+    result = await allocations.diff()
+    if result is None: return await ctx.send(f"📸 Allocation tracing started ({MEMORY_TRACE_FRAMES} frame{'s' * (MEMORY_TRACE_FRAMES > 1)}); run `memory` again later to see what grew, `memory off` to stop.")
+    since, stats = result
+    current, peak = tracemalloc.get_traced_memory()
+    header = f"growth over {timedelta(seconds=int(since))} · traced {current / 1048576:.1f} MB (peak {peak / 1048576:.1f}) · tracer overhead {tracemalloc.get_tracemalloc_memory() / 1048576:.1f} MB"
+    rows = [f"{stat.size_diff / 1024:+9.0f}KB {stat.count_diff:+8,}  {stat.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{stat.traceback[0].lineno}" for stat in stats]
+    await ctx.send(f"```\n{chr(10).join([header] + (rows or ['nothing grew']))[:1900]}\n```")
+
 # ==========================================
 # 🚑 HELP & TUTORIAL
 # ==========================================
 @bot.command()
 async def tutorial(ctx):
-    prefix = get_prefix(bot, ctx.message)
+    prefix = display_prefix(ctx.message)
     embed = discord.Embed(title="👋 Welcome to the Ultimate Mod Bot Tutorial!", description="Here's how to get your server set up.", color=discord.Color.blue())
     embed.add_field(name="Step 1: Set Admin & Mod Roles (Most Important!)", value=f"Only the **Server Owner** can do this first. This tells the bot who can use powerful commands.\n• `{prefix}setadminrole <role_name>`\n• `{prefix}setmodrole <role_name>`", inline=False)
     embed.add_field(name="Step 2: Configure Server Features (Optional)", value=f"Use these admin commands to enable automatic features.\n• `{prefix}setwelcomechannel <#channel>`\n• `{prefix}setgoodbyechannel <#channel>`\n• `{prefix}autorole <role_name>`\n• `{prefix}setprefix <new_prefix>`", inline=False)
@@ -865,13 +3549,13 @@ async def tutorial(ctx):
 
 @bot.command()
 async def help(ctx):
-    prefix = get_prefix(bot, ctx.message)
+    prefix = display_prefix(ctx.message)
     embed = discord.Embed(title="🤖 COMMAND LIST", description=f"My prefix is `{prefix}`. Type `{prefix}tutorial` for setup.", color=discord.Color.blurple())
     embed.add_field(name="🛠️ Server Setup (Admin Only)", value="`setadminrole`, `setmodrole`, `setprefix`, `setwelcomechannel`, `setgoodbyechannel`, `autorole`, `configview`, `resetserver`", inline=False)
-    embed.add_field(name="🛡️ Moderation (Moderator Role)", value="`warn`, `rmwarn`, `checkwarns`, `clearwarns`, `mute`, `unmute`, `timeout`, `kick`, `softban`, `ban`, `unban`, `purge`, `slowmode`, `lock`, `unlock`, `nickname`, `resetnick`, `embed`", inline=False)
-    embed.add_field(name="👑 Admin (Admin Role)", value="`announce`, `say`, `nuke`, `addrole`, `removerole`, `masskick`, `createtextchannel`, `createvoicechannel`, `setlevel`, `givexp`, `addmoney`, `removemoney`, `setxpcooldown`", inline=False)
+    embed.add_field(name="🛡️ Moderation (Moderator Role)", value="`warn`, `rmwarn`, `checkwarns`, `clearwarns`, `mute`, `tempmute`, `unmute`, `timeout`, `kick`, `softban`, `ban`, `tempban`, `unban`, `purge`, `slowmode`, `lock`, `unlock`, `raidlist`, `endraid`, `nickname`, `resetnick`, `embed`", inline=False)
+    embed.add_field(name="👑 Admin (Admin Role)", value="`announce`, `say`, `nuke`, `addrole`, `removerole`, `masskick`, `createtextchannel`, `createvoicechannel`, `setlevel`, `givexp`, `addmoney`, `removemoney`, `setxpcooldown`, `setlevelcurve`, `setmessageindex`, `setautomod`, `addbannedword`, `removebannedword`, `addresponse`, `removeresponse`, `setraidlockdown`, `raidban`", inline=False)
     embed.add_field(name="💸 XP & Economy", value="`rank`, `leaderboard`, `balance`, `daily`, `work`, `transfer`, `beg`, `richestrank`", inline=False)
-    embed.add_field(name="🎉 Fun & Utility", value="`avatar`, `serverinfo`, `userinfo`, `poll`, `ask`, `coinflip`, `latency`, `dice`, `whoami`, `choose`, `roll`, `weather`, `hug`, `slap`, `pairing`, `color`, `quote`, `backwards`, `math`, `remind`, `count`, `bottats`", inline=False)
+    embed.add_field(name="🎉 Fun & Utility", value="`avatar`, `serverinfo`, `userinfo`, `poll`, `ask`, `coinflip`, `latency`, `dice`, `whoami`, `choose`, `roll`, `weather`, `hug`, `slap`, `pairing`, `color`, `quote`, `backwards`, `math`, `remind`, `count`, `search`, `bottats`", inline=False)
     embed.set_footer(text="Arguments: <required> [optional]")
     await ctx.send(embed=embed)
 
@@ -879,5 +3563,8 @@ async def help(ctx):
 # 🚀 START
 # ==========================================
 if __name__ == "__main__":
-    keep_alive()
-    bot.run(TOKEN)
+    if not TOKEN:
+        print("FATAL ERROR: DISCORD_TOKEN environment variable not found. Please set it and restart.")
+        sys.exit()
+    try: bot.run(TOKEN)
+    finally: persistence.flush_sync()